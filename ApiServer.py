@@ -1,19 +1,39 @@
 import os
 import io
+import json
+import base64
+import zlib
+import time
+import asyncio
+import bisect
+import heapq
+import hashlib
+import itertools
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import gridfs
-from datetime import datetime
-from bson import ObjectId
+from datetime import datetime, timedelta
+from bson import ObjectId, json_util
 from fastapi import FastAPI, HTTPException, UploadFile, File, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, EmailStr, ValidationError
 from typing import List, Optional
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
-from fastapi import Body
-from gridfs.errors import NoFile
+from pymongo import MongoClient, InsertOne, UpdateOne, ReturnDocument, DESCENDING, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError, PyMongoError, OperationFailure
+from fastapi import Body, Header
+from gridfs.errors import NoFile, FileExists
 from fastapi.responses import Response
 from bson import ObjectId
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuración
 MONGO_URI = os.getenv(
     "MONGODB_URI",
@@ -21,12 +41,246 @@ MONGO_URI = os.getenv(
 )
 DB_NAME = "restaurant_system2"
 
+# MONGO_ASYNC=1 sirve las rutas de list/get/create desde el event loop con el
+# cliente async de PyMongo; si no, se usa el cliente sync en el threadpool
+MONGO_ASYNC = os.getenv("MONGO_ASYNC", "0") == "1"
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# Métricas (formato Prometheus en /metrics)
+# El middleware abre un RequestStats por request en un contextvar; los
+# listeners de PyMongo le suman los comandos y la espera por conexión.
+# run_in_threadpool copia el contexto, así que también funciona en handlers sync
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50]
+
+slow_log = logging.getLogger("restaurant_api.slow")
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _series(self, name, kind, help_text, buckets=None):
+        if name not in self._metrics:
+            self._metrics[name] = {"kind": kind, "help": help_text, "buckets": buckets, "series": {}}
+        return self._metrics[name]["series"]
+
+    def inc(self, name, help_text, labels, value=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series(name, "counter", help_text)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, help_text, buckets, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series(name, "histogram", help_text, buckets)
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = {"counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            hist["counts"][bisect.bisect_left(buckets, value)] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, metric in self._metrics.items():
+                lines.append(f"# HELP {name} {metric['help']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                for key, value in metric["series"].items():
+                    if metric["kind"] == "counter":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(metric["buckets"] + ["+Inf"], value["counts"]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + "}"
+
+metrics = MetricsRegistry()
+
+class RequestStats:
+    def __init__(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.commands = []
+        self._started = {}
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        stats = current_request.get()
+        if stats is not None and SLOW_REQUEST_MS:
+            stats._started[event.request_id] = event.command
+
+    def _finished(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        labels = {"command": event.command_name, "outcome": outcome}
+        metrics.observe("mongo_command_duration_seconds", "Duración de comandos MongoDB",
+                        LATENCY_BUCKETS, labels, seconds)
+        stats = current_request.get()
+        if stats is not None:
+            stats.mongo_commands += 1
+            stats.mongo_seconds += seconds
+            if SLOW_REQUEST_MS:
+                command = stats._started.pop(event.request_id, None)
+                stats.commands.append((event.command_name, round(seconds * 1000, 3), command))
+
+    def succeeded(self, event):
+        self._finished(event, "ok")
+
+    def failed(self, event):
+        self._finished(event, "error")
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    def connection_checked_out(self, event):
+        seconds = getattr(event, "duration", None) or 0.0
+        metrics.observe("mongo_pool_wait_seconds", "Espera para obtener una conexión del pool",
+                        LATENCY_BUCKETS, {}, seconds)
+        stats = current_request.get()
+        if stats is not None:
+            stats.pool_wait_seconds += seconds
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+mongo_listeners = [MongoCommandListener(), MongoPoolListener()]
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = {"code": 500, "size": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body":
+                status["size"] += len(message.get("body", b""))
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            record_request(scope, stats, status, time.perf_counter() - start)
+
+def record_request(scope, stats, status, seconds):
+    route = scope.get("route")
+    labels = {"method": scope["method"], "route": route.path if route else "unmatched"}
+    metrics.inc("http_requests_total", "Requests atendidos",
+                {**labels, "status": str(status["code"])})
+    metrics.observe("http_request_duration_seconds", "Latencia por ruta",
+                    LATENCY_BUCKETS, labels, seconds)
+    metrics.observe("http_request_mongo_seconds", "Tiempo en MongoDB por request",
+                    LATENCY_BUCKETS, labels, stats.mongo_seconds)
+    metrics.observe("http_request_mongo_commands", "Comandos MongoDB por request",
+                    COUNT_BUCKETS, labels, stats.mongo_commands)
+    metrics.observe("http_request_pool_wait_seconds", "Espera de pool por request",
+                    LATENCY_BUCKETS, labels, stats.pool_wait_seconds)
+    metrics.observe("http_response_size_bytes", "Tamaño de la respuesta",
+                    SIZE_BUCKETS, labels, status["size"])
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        slow_log.warning(
+            "slow request %s %s status=%s %.1fms mongo=%.1fms size=%s commands=%s",
+            labels["method"], labels["route"], status["code"], seconds * 1000,
+            stats.mongo_seconds * 1000, status["size"],
+            json_util.dumps(stats.commands)
+        )
+
 # Cliente MongoDB
-sync_client = MongoClient(MONGO_URI)
+sync_client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=mongo_listeners
+)
 db = sync_client[DB_NAME]
 fs = gridfs.GridFS(db)
 
+# Cliente async (solo si está activado)
+async_client = None
+adb = None
+if MONGO_ASYNC:
+    from pymongo import AsyncMongoClient
+    async_client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        event_listeners=mongo_listeners
+    )
+    adb = async_client[DB_NAME]
+
 app = FastAPI(title="Restaurant Orders & Reviews API")
+app.add_middleware(MetricsMiddleware)
+
+@app.on_event("startup")
+def configure_threadpool():
+    # Límite de hilos para los handlers sync (por defecto anyio usa 40)
+    import anyio.to_thread
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+@app.on_event("shutdown")
+async def close_clients():
+    if async_client is not None:
+        await async_client.close()
+    sync_client.close()
+
+# Acceso a datos para handlers async: cliente async si existe, si no el
+# cliente sync dentro del threadpool
+async def db_call(coll, method, *args, **kwargs):
+    if adb is not None:
+        return await getattr(adb[coll], method)(*args, **kwargs)
+    return await run_in_threadpool(getattr(db[coll], method), *args, **kwargs)
+
+async def db_find(coll, filt, proj=None, sort=None, skip=0, limit=0):
+    if adb is not None:
+        cursor = adb[coll].find(filt, proj)
+        if sort:
+            cursor = cursor.sort(sort)
+        return await cursor.skip(skip).limit(limit).to_list(length=None)
+
+    def run():
+        cursor = db[coll].find(filt, proj)
+        if sort:
+            cursor = cursor.sort(sort)
+        return list(cursor.skip(skip).limit(limit))
+    return await run_in_threadpool(run)
+
+async def db_aggregate(coll, pipeline):
+    if adb is not None:
+        cursor = await adb[coll].aggregate(pipeline)
+        return await cursor.to_list(length=None)
+    return await run_in_threadpool(lambda: list(db[coll].aggregate(pipeline)))
 
 # Helper para ObjectId
 class PyObjectId(ObjectId):
@@ -58,6 +312,11 @@ class Restaurant(BaseModel):
             datetime: lambda v: v.isoformat()
         }
 
+class NearbyRestaurant(Restaurant):
+    distance: float
+    avgRating: Optional[float] = None
+    ratingCount: Optional[int] = None
+
 class User(BaseModel):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     username: str
@@ -86,7 +345,8 @@ class MenuItem(BaseModel):
 class OrderItem(BaseModel):
     item_id: PyObjectId
     quantity: int
-    unit_price: float
+    # Lo fija el servidor con el precio vigente del plato
+    unit_price: Optional[float] = None
 
     class Config:
         json_encoders = {ObjectId: str}
@@ -97,6 +357,7 @@ class Order(BaseModel):
     restaurant_id: PyObjectId
     items: List[OrderItem]
     status: str
+    total: Optional[float] = None
     created_at: Optional[datetime] = None
 
     class Config:
@@ -128,27 +389,1332 @@ def parse_fields(fields: Optional[str]):
         return None
     return {f: 1 for f in fields.split(",")}
 
-def serialize_doc(doc):
-    serialized = {}
-    for key, value in doc.items():
-        if isinstance(value, ObjectId):
-            serialized[key] = str(value)
+def utcnow():
+    # MongoDB guarda fechas con precisión de milisegundos; truncar aquí hace
+    # que la respuesta construida desde el payload coincida con lo guardado
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Serialización rápida: una sola pasada de orjson (ObjectId en json_default)
+# sin construir modelos Pydantic intermedios
+def dumps_json(content):
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default)
+    return json.dumps(content, default=json_default, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return dumps_json(content)
+
+def parse_object_id(value, name="id"):
+    if not ObjectId.is_valid(value):
+        raise HTTPException(400, f"Invalid {name}")
+    return ObjectId(value)
+
+# Filtros comunes
+def date_range(start, end):
+    rng = {}
+    if start:
+        rng["$gte"] = start
+    if end:
+        rng["$lt"] = end
+    return rng
+
+def order_filters(user_id=None, restaurant_id=None, status=None,
+                  created_from=None, created_to=None):
+    filt = {}
+    if user_id:
+        filt["user_id"] = parse_object_id(user_id, "user_id")
+    if restaurant_id:
+        filt["restaurant_id"] = parse_object_id(restaurant_id, "restaurant_id")
+    if status:
+        filt["status"] = status
+    if created_from or created_to:
+        filt["created_at"] = date_range(created_from, created_to)
+    return filt
+
+def review_filters(user_id=None, restaurant_id=None, rating_min=None,
+                   rating_max=None, created_from=None, created_to=None):
+    filt = {}
+    if user_id:
+        filt["user_id"] = parse_object_id(user_id, "user_id")
+    if restaurant_id:
+        filt["restaurant_id"] = parse_object_id(restaurant_id, "restaurant_id")
+    if rating_min is not None or rating_max is not None:
+        filt["rating"] = {}
+        if rating_min is not None:
+            filt["rating"]["$gte"] = rating_min
+        if rating_max is not None:
+            filt["rating"]["$lte"] = rating_max
+    if created_from or created_to:
+        filt["created_at"] = date_range(created_from, created_to)
+    return filt
+
+def menu_item_filters(restaurant_id=None, tags=None):
+    filt = {}
+    if restaurant_id:
+        filt["restaurant_id"] = parse_object_id(restaurant_id, "restaurant_id")
+    if tags:
+        tag_list = [t for t in tags.split(",") if t]
+        filt["tags"] = tag_list[0] if len(tag_list) == 1 else {"$all": tag_list}
+    return filt
+
+# Paginación por cursor (keyset)
+# El token codifica el valor de la clave de orden y el _id del último
+# documento; la página siguiente es un rango sobre el índice (clave, _id)
+def get_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+def encode_cursor(doc, sort_by, order):
+    payload = {"s": sort_by, "o": order, "k": get_path(doc, sort_by), "id": doc["_id"]}
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode()
+
+def decode_cursor(token, sort_by, order):
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+    if payload.get("s") != sort_by or payload.get("o") != order:
+        raise HTTPException(400, "Cursor does not match sort_by/order")
+    return payload
+
+def keyset_query(sort_by, order, cursor=None, skip=0):
+    sort = [(sort_by, order)] if sort_by == "_id" else [(sort_by, order), ("_id", order)]
+    if not cursor:
+        return {}, sort
+    if skip:
+        raise HTTPException(400, "skip cannot be combined with cursor")
+    payload = decode_cursor(cursor, sort_by, order)
+    op = "$gt" if order == 1 else "$lt"
+    if sort_by == "_id":
+        return {"_id": {op: payload["id"]}}, sort
+    return {"$or": [
+        {sort_by: {op: payload["k"]}},
+        {sort_by: payload["k"], "_id": {op: payload["id"]}}
+    ]}, sort
+
+def with_sort_field(proj, sort_by):
+    if proj is not None and sort_by not in proj:
+        proj = {**proj, sort_by: 1}
+    return proj
+
+def next_cursor_headers(docs, sort_by, order, limit):
+    if len(docs) == limit:
+        return {"X-Next-Cursor": encode_cursor(docs[-1], sort_by, order)}
+    return {}
+
+# Multi-get (?ids=) y expansiones (?expand=)
+# Las referencias de todos los documentos de la respuesta se juntan por
+# colección, sin repetidos, y se resuelven con un solo $in por colección (en
+# paralelo): un pedido con todas sus expansiones son siempre 1 + 3 consultas,
+# tenga los items que tenga
+MULTI_GET_MAX = int(os.getenv("MULTI_GET_MAX", "100"))
+
+# expansión -> (colección, campo con la referencia); "items.item_id" expande
+# cada elemento de items en su campo "item"
+EXPANSIONS = {
+    "orders": {
+        "user": ("users", "user_id"),
+        "restaurant": ("restaurants", "restaurant_id"),
+        "items": ("menu_items", "items.item_id"),
+    },
+    "reviews": {
+        "user": ("users", "user_id"),
+        "restaurant": ("restaurants", "restaurant_id"),
+        "order": ("orders", "order_id"),
+    },
+}
+
+def parse_ids(ids):
+    values = [v for v in ids.split(",") if v]
+    if len(values) > MULTI_GET_MAX:
+        raise HTTPException(400, f"At most {MULTI_GET_MAX} ids")
+    return list(dict.fromkeys(parse_object_id(v, "ids") for v in values))
+
+def parse_expand(coll, expand):
+    if not expand:
+        return []
+    names = list(dict.fromkeys(expand.split(",")))
+    unknown = [n for n in names if n not in EXPANSIONS[coll]]
+    if unknown:
+        raise HTTPException(400, f"Unknown expand: {', '.join(unknown)}")
+    return names
+
+def with_expand_fields(proj, coll, names):
+    if proj is None:
+        return None
+    return {**proj, **{EXPANSIONS[coll][n][1].split(".")[0]: 1 for n in names}}
+
+async def multi_get(coll, ids, proj=None):
+    # Devuelve en el orden pedido; los ids que no existen se omiten
+    oids = parse_ids(ids)
+    docs = await db_find(coll, {"_id": {"$in": oids}}, proj)
+    by_id = {doc["_id"]: doc for doc in docs}
+    return [by_id[oid] for oid in oids if oid in by_id]
+
+class BatchLoader:
+    # Un loader por request: want() anota referencias y load() las trae
+    def __init__(self):
+        self.wanted = {}
+        self.loaded = {}
+
+    def want(self, coll, _id):
+        if _id is not None:
+            self.wanted.setdefault(coll, set()).add(_id)
+
+    async def load(self):
+        async def fetch(coll, ids):
+            docs = await db_find(coll, {"_id": {"$in": list(ids)}})
+            self.loaded.setdefault(coll, {}).update((doc["_id"], doc) for doc in docs)
+        pending = {
+            coll: ids - self.loaded.get(coll, {}).keys()
+            for coll, ids in self.wanted.items()
+        }
+        await asyncio.gather(*(fetch(coll, ids) for coll, ids in pending.items() if ids))
+        self.wanted = {}
+
+    def get(self, coll, _id):
+        return self.loaded.get(coll, {}).get(_id)
+
+async def expand_docs(coll, docs, names):
+    loader = BatchLoader()
+    refs = [EXPANSIONS[coll][n] for n in names]
+    for doc in docs:
+        for target, path in refs:
+            if path == "items.item_id":
+                for it in doc.get("items") or []:
+                    loader.want(target, it.get("item_id"))
+            else:
+                loader.want(target, doc.get(path))
+    await loader.load()
+    for doc in docs:
+        for name, (target, path) in zip(names, refs):
+            if path == "items.item_id":
+                for it in doc.get("items") or []:
+                    it["item"] = loader.get(target, it.get("item_id"))
+            elif path in doc:
+                doc[name] = loader.get(target, doc[path])
+    return docs
+
+# Asesor de consultas
+# Cada listado pasa su forma (colección, filtro, orden) por query_advisor antes
+# de ir a Mongo. Si ningún índice sirve el orden, QUERY_SHAPE_POLICY decide:
+# "fallback" usa el orden por defecto del listado, "reject" responde 400 y
+# "allow" solo la registra. La primera vez que se ejecuta una forma se corre
+# un explain (queryPlanner, no ejecuta la consulta) en un único hilo de fondo
+# y queda en /admin/query-shapes. sort_by y fields vienen del cliente: el
+# registro se corta en QUERY_SHAPES_MAX formas
+QUERY_SHAPE_POLICY = os.getenv("QUERY_SHAPE_POLICY", "fallback")
+QUERY_EXPLAIN = os.getenv("QUERY_EXPLAIN", "1") == "1"
+QUERY_SHAPES_MAX = int(os.getenv("QUERY_SHAPES_MAX", "500"))
+
+def filter_fields(filt):
+    # Igualdades (pueden ser prefijo del índice) y rangos por separado
+    equality, ranges = set(), set()
+    for key, value in filt.items():
+        if key.startswith("$"):
+            continue
+        if isinstance(value, dict) and any(k.startswith("$") for k in value):
+            ranges.add(key)
         else:
-            serialized[key] = value
-    return serialized
+            equality.add(key)
+    return equality, ranges
 
-def serialize_list(docs):
-    return [serialize_doc(doc) for doc in docs]
+def explain_summary(plan):
+    stages = []
+    indexes = []
+    node = plan.get("queryPlanner", {}).get("winningPlan", {})
+    while node:
+        stages.append(node.get("stage"))
+        if node.get("indexName"):
+            indexes.append(node["indexName"])
+        node = node.get("inputStage") or (node.get("inputStages") or [None])[0]
+    return {"stages": stages, "indexes": indexes}
 
-# Agregaciones
-@app.get("/restaurants/top-rated")
-def top_rated(limit: int = 10):
-    pipeline = [
+class QueryAdvisor:
+    def __init__(self, database, policy, explain=True, max_shapes=500):
+        self.database = database
+        self.policy = policy
+        self.explain = explain
+        self.max_shapes = max_shapes
+        self.indexes = {}
+        self.shapes = {}
+        self.dropped = 0
+        self._explainer = None
+        self._lock = threading.Lock()
+
+    def load_indexes(self, coll):
+        # Solo índices ordenables (se ignoran text y 2dsphere)
+        info = self.database[coll].index_information()
+        self.indexes[coll] = [
+            spec["key"] for spec in info.values()
+            if all(isinstance(d, int) for _, d in spec["key"])
+        ]
+
+    def reload(self):
+        self.indexes = {}
+
+    def sort_index(self, coll, equality, sort):
+        # Ordenar por un campo fijado por igualdad no cuesta nada
+        # Entre los que sirven, el que más igualdades usa como prefijo
+        sort = [(k, d) for k, d in sort if k not in equality]
+        best, best_prefix = None, -1
+        for keys in self.indexes[coll]:
+            for p in range(len(keys) - len(sort) + 1):
+                window = keys[p:p + len(sort)]
+                if [k for k, _ in window] == [k for k, _ in sort]:
+                    same = all(d == sd for (_, d), (_, sd) in zip(window, sort))
+                    inverse = all(d == -sd for (_, d), (_, sd) in zip(window, sort))
+                    if (same or inverse) and p > best_prefix:
+                        best, best_prefix = keys, p
+                if keys[p][0] not in equality:
+                    break
+        return best
+
+    def filter_index(self, coll, fields):
+        return next((keys for keys in self.indexes[coll] if keys[0][0] in fields), None)
+
+    def sortable_fields(self, coll, equality):
+        fields = {k for keys in self.indexes[coll] for k, _ in keys}
+        return sorted(
+            f for f in fields
+            if self.sort_index(coll, equality, keyset_query(f, 1)[1])
+        )
+
+    def check(self, coll, filt, sort_by, order, default, proj=None):
+        if coll not in self.indexes:
+            self.load_indexes(coll)
+        sort = keyset_query(sort_by, order)[1]
+        equality, ranges = filter_fields(filt)
+        index = self.sort_index(coll, equality, sort)
+        if index:
+            plan = "IXSCAN"
+        elif self.filter_index(coll, equality | ranges):
+            plan = "IXSCAN+SORT"
+        else:
+            plan = "COLLSCAN+SORT"
+        covered = bool(index and proj) and all(
+            f in {k for k, _ in index} for f in {**proj, "_id": 1}
+        ) and all(f in {k for k, _ in index} for f in equality | ranges)
+        if index or self.policy == "allow":
+            self.record(coll, filt, sort, equality, ranges, plan, index, proj, covered, "executed")
+            return sort_by, order, False
+        # La forma pedida no llega a Mongo: se cuenta, pero sin explain
+        self.record(coll, filt, sort, equality, ranges, plan, index, proj, covered, self.policy)
+        if self.policy == "reject":
+            raise HTTPException(
+                400,
+                f"sort_by={sort_by} is not backed by an index on {coll}; "
+                f"sortable fields: {', '.join(self.sortable_fields(coll, equality))}"
+            )
+        return default[0], default[1], True
+
+    def record(self, coll, filt, sort, equality, ranges, plan, index, proj, covered, outcome):
+        fields = sorted(proj) if proj else None
+        key = (coll, tuple(sorted(equality)), tuple(sorted(ranges)), tuple(sort), tuple(fields or ()))
+        with self._lock:
+            shape = self.shapes.get(key)
+            first = shape is None
+            if first:
+                if len(self.shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                shape = self.shapes[key] = {
+                    "collection": coll,
+                    "equality": sorted(equality),
+                    "range": sorted(ranges),
+                    "sort": [f"{k}:{d}" for k, d in sort],
+                    "plan": plan,
+                    "index": [f"{k}:{d}" for k, d in index] if index else None,
+                    "fields": fields,
+                    "covered": covered,
+                    "outcome": outcome,
+                    "count": 0,
+                    "explain": None,
+                }
+            shape["count"] += 1
+            shape["outcome"] = outcome
+            if first and self.explain and outcome == "executed":
+                if self._explainer is None:
+                    self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-explain")
+                self._explainer.submit(self.run_explain, shape, coll, filt, sort, proj)
+
+    def run_explain(self, shape, coll, filt, sort, proj):
+        # queryPlanner solo elige el plan; executionStats correría la consulta
+        command = {"find": coll, "filter": filt, "sort": dict(sort), "limit": 50}
+        if proj:
+            command["projection"] = proj
+        try:
+            plan = self.database.command({"explain": command, "verbosity": "queryPlanner"})
+            shape["explain"] = explain_summary(plan)
+        except Exception as exc:
+            shape["explain"] = {"error": str(exc)}
+
+    def report(self):
+        with self._lock:
+            shapes = [dict(s) for s in self.shapes.values()]
+        for shape in shapes:
+            if shape["plan"] != "IXSCAN":
+                # Índice sugerido: igualdades, luego orden (ESR)
+                shape["suggested_index"] = shape["equality"] + shape["sort"]
+        return sorted(shapes, key=lambda s: s["count"], reverse=True)
+
+query_advisor = QueryAdvisor(db, QUERY_SHAPE_POLICY, QUERY_EXPLAIN, QUERY_SHAPES_MAX)
+
+async def db_check_query(coll, filt, sort_by, order, default, proj=None):
+    # La carga de índices es I/O sync: solo la primera vez por colección
+    if coll not in query_advisor.indexes:
+        await run_in_threadpool(query_advisor.load_indexes, coll)
+    return query_advisor.check(coll, filt, sort_by, order, default, proj)
+
+def sort_fallback_headers(headers, fallback, sort_by, order):
+    if fallback:
+        headers["X-Sort-Fallback"] = f"{sort_by}:{order}"
+    return headers
+
+@app.get("/admin/query-shapes")
+def query_shapes():
+    return {
+        "policy": query_advisor.policy,
+        "shapes": query_advisor.report(),
+        "dropped": query_advisor.dropped,
+    }
+
+@app.post("/admin/query-shapes/reload-indexes")
+def reload_query_indexes():
+    query_advisor.reload()
+    return {"reloaded": True}
+
+# Cache de respuestas
+# Backend "memory" (LRU por proceso) por defecto; "mongo" comparte la cache
+# entre workers usando la colección response_cache
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTLS = {
+    "top_rated": int(os.getenv("CACHE_TTL_TOP_RATED", "60")),
+    "most_ordered": int(os.getenv("CACHE_TTL_MOST_ORDERED", "60")),
+    "distinct_categories": int(os.getenv("CACHE_TTL_DISTINCT_CATEGORIES", "300")),
+    "count_reviews": int(os.getenv("CACHE_TTL_COUNT_REVIEWS", "30")),
+}
+# Rutas cacheadas que dependen de cada colección
+CACHE_DEPENDENCIES = {
+    "restaurants": ["top_rated", "distinct_categories"],
+    "menu_items": ["most_ordered"],
+    "orders": ["most_ordered"],
+    "reviews": ["top_rated", "count_reviews"],
+}
+
+class CacheBackend:
+    # Interfaz para backends compartidos (Redis, Mongo, ...)
+    blocking = False
+
+    def setup(self):
+        pass
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        raise NotImplementedError
+
+    def size(self):
+        raise NotImplementedError
+
+class MemoryCacheBackend(CacheBackend):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def size(self):
+        return len(self._data)
+
+class MongoCacheBackend(CacheBackend):
+    # El índice TTL sobre expires_at limpia las entradas vencidas
+    blocking = True
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def setup(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+        self.collection.create_index("prefix")
+
+    def get(self, key):
+        doc = self.collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.utcnow()}}, {"value": 1}
+        )
+        return doc["value"] if doc else None
+
+    def set(self, key, value, ttl):
+        self.collection.replace_one({"_id": key}, {
+            "prefix": key.split(":", 1)[0] + ":",
+            "value": value,
+            "expires_at": datetime.utcnow() + timedelta(seconds=ttl)
+        }, upsert=True)
+
+    def delete_prefix(self, prefix):
+        self.collection.delete_many({"prefix": prefix})
+
+    def size(self):
+        return self.collection.estimated_document_count()
+
+class ResponseCache:
+    def __init__(self, backend, ttls, dependencies):
+        self.backend = backend
+        self.ttls = ttls
+        self.dependencies = dependencies
+        self.hits = {}
+        self.misses = {}
+        # Generación por ruta: evita guardar un resultado calculado antes de
+        # una invalidación concurrente
+        self._generations = {}
+
+    def key(self, route, params):
+        return f"{route}:{json.dumps(params, sort_keys=True, default=str)}"
+
+    def cached(self, route, params, compute):
+        key = self.key(route, params)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits[route] = self.hits.get(route, 0) + 1
+            return value
+        self.misses[route] = self.misses.get(route, 0) + 1
+        generation = self._generations.get(route, 0)
+        value = compute()
+        if self._generations.get(route, 0) == generation:
+            self.backend.set(key, value, self.ttls[route])
+        return value
+
+    def invalidate(self, route):
+        self._generations[route] = self._generations.get(route, 0) + 1
+        self.backend.delete_prefix(route + ":")
+
+    def invalidate_collection(self, coll):
+        for route in self.dependencies.get(coll, []):
+            self.invalidate(route)
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "routes": {
+                route: {"hits": self.hits.get(route, 0), "misses": self.misses.get(route, 0)}
+                for route in self.ttls
+            }
+        }
+
+if CACHE_BACKEND == "mongo":
+    response_cache = ResponseCache(MongoCacheBackend(db.response_cache), CACHE_TTLS, CACHE_DEPENDENCIES)
+else:
+    response_cache = ResponseCache(MemoryCacheBackend(CACHE_MAX_ENTRIES), CACHE_TTLS, CACHE_DEPENDENCIES)
+
+# /search tiene su propia LRU chica en memoria: solo se quedan las búsquedas
+# populares y no desplazan a las agregaciones
+SEARCH_CACHE_ENTRIES = int(os.getenv("SEARCH_CACHE_ENTRIES", "256"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "60"))
+search_cache = ResponseCache(
+    MemoryCacheBackend(SEARCH_CACHE_ENTRIES),
+    {"search": SEARCH_CACHE_TTL},
+    {"restaurants": ["search"], "menu_items": ["search"]}
+)
+
+@app.on_event("startup")
+def setup_cache():
+    response_cache.backend.setup()
+
+def invalidate_cache(coll):
+    response_cache.invalidate_collection(coll)
+    search_cache.invalidate_collection(coll)
+
+async def db_invalidate_cache(coll):
+    if response_cache.backend.blocking:
+        await run_in_threadpool(response_cache.invalidate_collection, coll)
+    else:
+        response_cache.invalidate_collection(coll)
+    search_cache.invalidate_collection(coll)
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**response_cache.stats(), "search": search_cache.stats()}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # Los contadores de la cache se publican al momento de leer
+    lines = [metrics.render()]
+    routes = {**response_cache.stats()["routes"], **search_cache.stats()["routes"]}
+    for result in ("hits", "misses"):
+        lines.append(f"# TYPE response_cache_{result}_total counter\n")
+        for route, counts in routes.items():
+            lines.append(f'response_cache_{result}_total{{route="{route}"}} {counts[result]}\n')
+    return Response("".join(lines), media_type="text/plain; version=0.0.4")
+
+# Coalescing de lecturas (single-flight)
+# Requests idénticos concurrentes (misma ruta y parámetros) comparten una sola
+# llamada a MongoDB: el primero la ejecuta y el resto espera su resultado. No
+# guarda nada al terminar; las escrituras llaman a forget para que los
+# requests nuevos no se sumen a una lectura que empezó antes del cambio
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self._loop = None
+
+    def _count(self, route, role):
+        metrics.inc("singleflight_requests_total", "Lecturas por ruta: leader ejecuta, coalesced espera",
+                    {"route": route, "role": role})
+
+    def do(self, route, params, fn):
+        # Handlers sync (threadpool)
+        key = (route, params)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        self._count(route, "leader" if leader else "coalesced")
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as exc:
+            call["error"] = exc
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call["done"].set()
+
+    async def do_async(self, route, params, fn):
+        # Handlers async: fn devuelve un awaitable; shield evita que un
+        # cliente que se desconecta cancele la llamada de los demás.
+        # _tasks solo se toca desde el event loop (ver forget)
+        key = (route, params)
+        self._loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        self._count(route, "coalesced" if task else "leader")
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._task_done(key, t))
+        return await asyncio.shield(task)
+
+    def _task_done(self, key, task):
+        if self._tasks.get(key) is task:
+            self._tasks.pop(key, None)
+
+    def forget(self, route, params):
+        # Se llama desde handlers sync (threadpool) y async: la parte de
+        # _tasks se pasa al event loop
+        key = (route, params)
+        with self._lock:
+            self._calls.pop(key, None)
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._tasks.pop(key, None)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(self._tasks.pop, key, None)
+
+single_flight = SingleFlight()
+
+# Proyecciones materializadas
+# Cada escritura calcula el aporte del documento antes y después del cambio y
+# aplica la diferencia con $inc/pipelines atómicos sobre la colección derivada
+def write_projection(coll, ops):
+    if ops:
+        db[coll].bulk_write(ops, ordered=False)
+
+async def db_write_projection(coll, ops):
+    if ops:
+        await db_call(coll, "bulk_write", ops, ordered=False)
+
+def write_projections(changes):
+    for coll, ops in changes:
+        write_projection(coll, ops)
+
+async def db_write_projections(changes):
+    for coll, ops in changes:
+        await db_write_projection(coll, ops)
+
+# Resumen de rating por restaurante (restaurant_ratings)
+def rating_summary_ops(before, after):
+    deltas = {}
+    for doc, sign in ((before, -1), (after, 1)):
+        if doc and doc.get("restaurant_id") is not None:
+            delta = deltas.setdefault(doc["restaurant_id"], [0, 0])
+            delta[0] += sign * doc["rating"]
+            delta[1] += sign
+    ops = []
+    for restaurant_id, (rating, count) in deltas.items():
+        if rating == 0 and count == 0:
+            continue
+        ops.append(UpdateOne({"_id": restaurant_id}, [
+            {"$set": {
+                "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, rating]},
+                "count": {"$add": [{"$ifNull": ["$count", 0]}, count]}
+            }},
+            {"$set": {"avgRating": {"$cond": [
+                {"$gt": ["$count", 0]},
+                {"$divide": ["$rating_sum", "$count"]},
+                None
+            ]}}}
+        ], upsert=True))
+    return ops
+
+def rebuild_rating_summaries(database=None):
+    database = db if database is None else database
+    database.reviews.aggregate([
+        {"$match": {"restaurant_id": {"$ne": None}}},
         {"$group": {
             "_id": "$restaurant_id",
-            "avgRating": {"$avg": "$rating"},
+            "rating_sum": {"$sum": "$rating"},
             "count": {"$sum": 1}
         }},
+        {"$set": {"avgRating": {"$divide": ["$rating_sum", "$count"]}}},
+        {"$out": "restaurant_ratings"}
+    ])
+    database.restaurant_ratings.create_index([("avgRating", DESCENDING)])
+    return database.restaurant_ratings.count_documents({})
+
+@app.post("/admin/rebuild/rating-summaries")
+def rebuild_rating_summaries_endpoint():
+    count = rebuild_rating_summaries()
+    response_cache.invalidate("top_rated")
+    return {"restaurants": count}
+
+# Cantidad pedida por plato (menu_item_order_counts)
+def item_counter_ops(before, after):
+    deltas = {}
+    for doc, sign in ((before, -1), (after, 1)):
+        for it in (doc or {}).get("items", []):
+            deltas[it["item_id"]] = deltas.get(it["item_id"], 0) + sign * it["quantity"]
+    return [
+        UpdateOne({"_id": item_id}, {"$inc": {"totalQty": qty}}, upsert=True)
+        for item_id, qty in deltas.items() if qty != 0
+    ]
+
+def rebuild_item_order_counts(database=None):
+    database = db if database is None else database
+    database.orders.aggregate([
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.item_id",
+            "totalQty": {"$sum": "$items.quantity"}
+        }},
+        {"$out": "menu_item_order_counts"}
+    ])
+    database.menu_item_order_counts.create_index([("totalQty", DESCENDING)])
+    return database.menu_item_order_counts.count_documents({})
+
+@app.post("/admin/rebuild/item-order-counts")
+def rebuild_item_order_counts_endpoint():
+    count = rebuild_item_order_counts()
+    response_cache.invalidate("most_ordered")
+    return {"menu_items": count}
+
+# Estadísticas por usuario (user_stats)
+# Pedidos y gasto (sin cancelados) desde orders; reseñas y rating promedio
+# dado desde reviews
+def order_amount(doc):
+    if doc.get("total") is not None:
+        return doc["total"]
+    return order_total(doc.get("items", []))
+
+def user_order_contribution(doc):
+    spend = 0 if doc.get("status") == "cancelled" else order_amount(doc)
+    return {"order_count": 1, "spend": spend}
+
+def user_review_contribution(doc):
+    return {"review_count": 1, "rating_sum": doc["rating"]}
+
+def user_stats_ops(before, after, contribution):
+    deltas = {}
+    for doc, sign in ((before, -1), (after, 1)):
+        if doc and doc.get("user_id") is not None:
+            delta = deltas.setdefault(doc["user_id"], {})
+            for field, value in contribution(doc).items():
+                delta[field] = delta.get(field, 0) + sign * value
+    ops = []
+    for user_id, delta in deltas.items():
+        if not any(delta.values()):
+            continue
+        ops.append(UpdateOne({"_id": user_id}, [
+            {"$set": {
+                field: {"$add": [{"$ifNull": [f"${field}", 0]}, value]}
+                for field, value in delta.items()
+            }},
+            USER_STATS_DERIVED_STAGE
+        ], upsert=True))
+    return ops
+
+USER_STATS_DERIVED_STAGE = {"$set": {
+    "spend": {"$round": [{"$ifNull": ["$spend", 0]}, 2]},
+    "avgRating": {"$cond": [
+        {"$gt": [{"$ifNull": ["$review_count", 0]}, 0]},
+        {"$divide": ["$rating_sum", "$review_count"]},
+        None
+    ]}
+}}
+
+def user_stats_doc(doc):
+    # Mismos campos derivados que USER_STATS_DERIVED_STAGE, calculados en Python
+    stats = {"order_count": 0, "spend": 0, "review_count": 0, "rating_sum": 0, **doc}
+    stats["spend"] = round(stats["spend"], 2)
+    stats["avgRating"] = stats["rating_sum"] / stats["review_count"] if stats["review_count"] else None
+    return stats
+
+def rebuild_user_stats(database=None):
+    # Un $group por colección, los dos ordenados por usuario: se juntan en una
+    # sola pasada sin cargarlos en memoria y se reemplaza la colección de una
+    # vez (rename)
+    database = db if database is None else database
+    orders = database.orders.aggregate([
+        {"$match": {"user_id": {"$ne": None}}},
+        {"$group": {
+            "_id": "$user_id",
+            "order_count": {"$sum": 1},
+            "spend": {"$sum": {"$cond": [
+                {"$eq": ["$status", "cancelled"]},
+                0,
+                {"$ifNull": ["$total", {"$sum": {"$map": {
+                    "input": "$items",
+                    "in": {"$multiply": ["$$this.quantity", "$$this.unit_price"]}
+                }}}]}
+            ]}}
+        }},
+        {"$sort": {"_id": 1}}
+    ], allowDiskUse=True)
+    reviews = database.reviews.aggregate([
+        {"$match": {"user_id": {"$ne": None}}},
+        {"$group": {
+            "_id": "$user_id",
+            "review_count": {"$sum": 1},
+            "rating_sum": {"$sum": "$rating"}
+        }},
+        {"$sort": {"_id": 1}}
+    ], allowDiskUse=True)
+    database.drop_collection("user_stats_tmp")
+    tmp = database.user_stats_tmp
+    count = 0
+    batch = []
+    merged = heapq.merge(orders, reviews, key=lambda doc: doc["_id"])
+    for _, group in itertools.groupby(merged, key=lambda doc: doc["_id"]):
+        doc = {}
+        for part in group:
+            doc.update(part)
+        batch.append(user_stats_doc(doc))
+        if len(batch) == 5000:
+            tmp.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        tmp.insert_many(batch, ordered=False)
+        count += len(batch)
+    if count:
+        tmp.rename("user_stats", dropTarget=True)
+    else:
+        database.drop_collection("user_stats_tmp")
+        database.drop_collection("user_stats")
+    return count
+
+@app.post("/admin/rebuild/user-stats")
+def rebuild_user_stats_endpoint():
+    return {"users": rebuild_user_stats()}
+
+# Rollups por hora y día (restaurant_rollups)
+# Un documento por (restaurante, granularidad, bucket) con ventas, pedidos por
+# status, cantidad por plato e histograma de ratings. El bucket sale de
+# created_at, que no cambia al actualizar, así que cada cambio es un $inc
+ROLLUP_GRANULARITIES = {
+    "hour": lambda dt: dt.replace(minute=0, second=0, microsecond=0),
+    "day": lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+ROLLUP_FIELDS = {
+    "orders": {"restaurant_id": 1, "created_at": 1, "status": 1, "items": 1, "total": 1},
+    "reviews": {"restaurant_id": 1, "created_at": 1, "rating": 1},
+}
+
+def rollup_key(value):
+    # Se usa como nombre de campo: sin "." ni "$"
+    return str(value).replace(".", "_").replace("$", "_")
+
+def order_rollup_contribution(doc):
+    inc = {
+        "order_count": 1,
+        "revenue": 0 if doc.get("status") == "cancelled" else order_amount(doc),
+        f"status.{rollup_key(doc.get('status'))}": 1,
+    }
+    for it in doc.get("items", []):
+        path = f"items.{it['item_id']}"
+        inc[path] = inc.get(path, 0) + it["quantity"]
+    return inc
+
+def review_rollup_contribution(doc):
+    return {"review_count": 1, "rating_sum": doc["rating"], f"ratings.{rollup_key(doc['rating'])}": 1}
+
+def rollup_deltas(pairs, contribution, deltas=None):
+    deltas = {} if deltas is None else deltas
+    for before, after in pairs:
+        for doc, sign in ((before, -1), (after, 1)):
+            if not doc or doc.get("restaurant_id") is None or doc.get("created_at") is None:
+                continue
+            values = contribution(doc)
+            for granularity, truncate in ROLLUP_GRANULARITIES.items():
+                key = (doc["restaurant_id"], granularity, truncate(doc["created_at"]))
+                delta = deltas.setdefault(key, {})
+                for path, value in values.items():
+                    delta[path] = delta.get(path, 0) + sign * value
+    return deltas
+
+def rollup_ops(before, after, contribution):
+    ops = []
+    for (restaurant_id, granularity, bucket), delta in rollup_deltas([(before, after)], contribution).items():
+        delta = {path: value for path, value in delta.items() if value}
+        if delta:
+            ops.append(UpdateOne(
+                {"restaurant_id": restaurant_id, "granularity": granularity, "bucket": bucket},
+                {"$inc": delta}, upsert=True
+            ))
+    return ops
+
+def create_rollup_indexes(collection):
+    collection.create_index([("restaurant_id", 1), ("granularity", 1), ("bucket", 1)], unique=True)
+    collection.create_index([("granularity", 1), ("bucket", 1)])
+
+def rollup_stream(database, coll, contribution):
+    cursor = database[coll].find({"restaurant_id": {"$ne": None}}, ROLLUP_FIELDS[coll])\
+        .sort("restaurant_id", 1).batch_size(5000)
+    for doc in cursor:
+        yield doc, contribution
+
+def rollup_doc(key, delta):
+    restaurant_id, granularity, bucket = key
+    doc = {"restaurant_id": restaurant_id, "granularity": granularity, "bucket": bucket}
+    for path, value in delta.items():
+        parent, _, field = path.rpartition(".")
+        (doc.setdefault(parent, {}) if parent else doc)[field] = value
+    return doc
+
+def rebuild_rollups(database=None):
+    # Recorre orders y reviews ordenados por restaurante (índices
+    # (restaurant_id, created_at, _id)) con las mismas funciones de aporte que
+    # usan las escrituras: en memoria solo quedan los buckets del restaurante
+    # actual. Reemplaza la colección de una vez (rename)
+    database = db if database is None else database
+    merged = heapq.merge(
+        rollup_stream(database, "orders", order_rollup_contribution),
+        rollup_stream(database, "reviews", review_rollup_contribution),
+        key=lambda pair: pair[0]["restaurant_id"]
+    )
+    database.drop_collection("restaurant_rollups_tmp")
+    tmp = database.restaurant_rollups_tmp
+    count = 0
+    batch = []
+    for _, group in itertools.groupby(merged, key=lambda pair: pair[0]["restaurant_id"]):
+        deltas = {}
+        for doc, contribution in group:
+            rollup_deltas([(None, doc)], contribution, deltas)
+        batch.extend(rollup_doc(key, delta) for key, delta in deltas.items())
+        if len(batch) >= 5000:
+            tmp.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        tmp.insert_many(batch, ordered=False)
+        count += len(batch)
+    create_rollup_indexes(tmp)
+    if count:
+        tmp.rename("restaurant_rollups", dropTarget=True)
+    else:
+        database.drop_collection("restaurant_rollups_tmp")
+        database.drop_collection("restaurant_rollups")
+    return count
+
+@app.post("/admin/rebuild/rollups")
+def rebuild_rollups_endpoint():
+    return {"buckets": rebuild_rollups()}
+
+# Proyecciones afectadas por cada colección
+def order_projection_ops(before, after):
+    return [
+        ("menu_item_order_counts", item_counter_ops(before, after)),
+        ("user_stats", user_stats_ops(before, after, user_order_contribution)),
+        ("restaurant_rollups", rollup_ops(before, after, order_rollup_contribution)),
+    ]
+
+def review_projection_ops(before, after):
+    return [
+        ("restaurant_ratings", rating_summary_ops(before, after)),
+        ("user_stats", user_stats_ops(before, after, user_review_contribution)),
+        ("restaurant_rollups", rollup_ops(before, after, review_rollup_contribution)),
+    ]
+
+def collect_projections(projection_ops, pairs):
+    # Junta las operaciones de varios cambios: un bulk_write por colección derivada
+    changes = {}
+    for before, after in pairs:
+        for coll, ops in projection_ops(before, after):
+            changes.setdefault(coll, []).extend(ops)
+    return list(changes.items())
+
+# Menú desnormalizado por restaurante (restaurant_menus)
+# Un documento por restaurante con el restaurante y todos sus platos, para que
+# /restaurants/{rid}/menu sea una sola lectura. Se rearma entero cuando se
+# escribe un plato o el restaurante; version cuenta los rearmados y el ETag es
+# un hash del contenido, así un rearmado sin cambios (o un rebuild completo)
+# sigue respondiendo 304.
+# Entre procesos: cada rearmado toma un número de seq antes de leer y solo
+# escribe si ningún rearmado posterior escribió ya (built_seq < seq), así un
+# snapshot viejo nunca pisa a uno más nuevo. El rebuild completo deja seq en 0:
+# la escritura sube seq con $max para que los rearmados siguientes tomen un
+# número mayor que el built_seq que deja un rearmado que estaba en curso
+MENU_INTERNAL_FIELDS = {"seq": 0, "built_seq": 0}
+
+def menu_etag(restaurant, items):
+    content = dumps_json({"restaurant": restaurant, "items": items})
+    return '"%s"' % hashlib.sha256(content).hexdigest()
+
+def menu_snapshot(restaurant, items):
+    return {
+        "restaurant": restaurant,
+        "items": items,
+        "item_count": len(items),
+        "etag": menu_etag(restaurant, items),
+        "updated_at": utcnow(),
+    }
+
+def build_menu(restaurant_id, database=None):
+    database = db if database is None else database
+    menus = database.restaurant_menus
+    # Un GET de un restaurante que no existe no escribe nada
+    if not database.restaurants.find_one({"_id": restaurant_id}, {"_id": 1}):
+        if menus.find_one({"_id": restaurant_id}, {"_id": 1}):
+            menus.delete_one({"_id": restaurant_id})
+        return None
+    seq = menus.find_one_and_update(
+        {"_id": restaurant_id},
+        {"$inc": {"seq": 1}, "$setOnInsert": {"built_seq": 0}},
+        {"seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )["seq"]
+    restaurant = database.restaurants.find_one({"_id": restaurant_id})
+    if not restaurant:
+        # Se borró entre la comprobación y el seq
+        menus.delete_one({"_id": restaurant_id})
+        return None
+    items = list(database.menu_items.find(
+        {"restaurant_id": restaurant_id}, {"restaurant_id": 0}
+    ).sort([("name", 1), ("_id", 1)]))
+    doc = menus.find_one_and_update(
+        {"_id": restaurant_id, "built_seq": {"$lt": seq}},
+        {"$set": {**menu_snapshot(restaurant, items), "built_seq": seq},
+         "$max": {"seq": seq}, "$inc": {"version": 1}},
+        MENU_INTERNAL_FIELDS,
+        return_document=ReturnDocument.AFTER
+    )
+    # Un rearmado posterior ya escribió: su snapshot es el vigente
+    return doc or menus.find_one({"_id": restaurant_id}, MENU_INTERNAL_FIELDS)
+
+def rebuild_menus(restaurant_ids):
+    for restaurant_id in restaurant_ids:
+        build_menu(restaurant_id)
+        single_flight.forget("get_restaurant_menu", str(restaurant_id))
+
+def menu_restaurants(*docs):
+    return {doc["restaurant_id"] for doc in docs if doc and doc.get("restaurant_id") is not None}
+
+def rebuild_restaurant_menus(database=None):
+    # menu_items ordenado por (restaurant_id, name, _id) y restaurants por _id:
+    # se recorren juntos y en memoria solo queda el menú del restaurante
+    # actual. Reemplaza la colección de una vez (rename)
+    database = db if database is None else database
+    cursor = database.menu_items.find({"restaurant_id": {"$ne": None}})\
+        .sort([("restaurant_id", 1), ("name", 1), ("_id", 1)]).batch_size(5000)
+    groups = itertools.groupby(cursor, key=lambda item: item["restaurant_id"])
+    current = next(groups, None)
+    database.drop_collection("restaurant_menus_tmp")
+    tmp = database.restaurant_menus_tmp
+    count = 0
+    docs = []
+    for restaurant in database.restaurants.find({}).sort("_id", 1).batch_size(5000):
+        # Platos de restaurantes que ya no existen
+        while current and current[0] < restaurant["_id"]:
+            current = next(groups, None)
+        items = []
+        if current and current[0] == restaurant["_id"]:
+            for item in current[1]:
+                del item["restaurant_id"]
+                items.append(item)
+            current = next(groups, None)
+        docs.append({"_id": restaurant["_id"], "version": 1, "seq": 0, "built_seq": 0,
+                     **menu_snapshot(restaurant, items)})
+        if len(docs) == 5000:
+            tmp.insert_many(docs, ordered=False)
+            count += len(docs)
+            docs = []
+    if docs:
+        tmp.insert_many(docs, ordered=False)
+        count += len(docs)
+    if count:
+        tmp.rename("restaurant_menus", dropTarget=True)
+    else:
+        database.drop_collection("restaurant_menus_tmp")
+        database.drop_collection("restaurant_menus")
+    return count
+
+@app.post("/admin/rebuild/menus")
+def rebuild_menus_endpoint():
+    return {"restaurants": rebuild_restaurant_menus()}
+
+# Índice de precios del menú
+# Precio y restaurante de cada plato en memoria para validar pedidos y
+# calcular totales sin ir a menu_items. Se carga al arrancar y se mantiene
+# con los hooks de escritura de menu_items; con MENU_INDEX_WATCH=1 además
+# sigue un change stream (requiere replica set) para ver las escrituras de
+# otros procesos; sin él se recarga completo cada MENU_INDEX_REFRESH segundos,
+# que es lo más viejo que puede estar un precio o un borrado hecho por otro
+# worker. Un plato que no está se busca una vez en MongoDB
+MENU_INDEX_WATCH = os.getenv("MENU_INDEX_WATCH", "0") == "1"
+MENU_INDEX_REFRESH = float(os.getenv("MENU_INDEX_REFRESH", "300"))
+
+menu_index_log = logging.getLogger("restaurant_api.menu_index")
+
+class MenuPriceIndex:
+    def __init__(self, collection):
+        self.collection = collection
+        self._items = {}
+        self._lock = threading.Lock()
+        # Escrituras de los hooks mientras corre una carga (None: no hay carga)
+        self._pending = None
+        self.loaded = False
+        self.watching = False
+        self.fetches = 0
+        self.reloads = 0
+
+    def put(self, doc):
+        entry = (doc["price"], doc["restaurant_id"])
+        with self._lock:
+            self._items[doc["_id"]] = entry
+            if self._pending is not None:
+                self._pending[doc["_id"]] = entry
+
+    def remove(self, item_id):
+        with self._lock:
+            self._items.pop(item_id, None)
+            if self._pending is not None:
+                self._pending[item_id] = None
+
+    def load(self):
+        # Arma un dict nuevo y lo reemplaza entero; lo que escribieron los
+        # hooks durante la carga se aplica encima, así gana sobre la lectura
+        with self._lock:
+            self._pending = {}
+        items = {}
+        try:
+            for doc in self.collection.find({}, {"price": 1, "restaurant_id": 1}).batch_size(10000):
+                items[doc["_id"]] = (doc["price"], doc["restaurant_id"])
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for item_id, entry in self._pending.items():
+                if entry is None:
+                    items.pop(item_id, None)
+                else:
+                    items[item_id] = entry
+            self._items = items
+            self._pending = None
+        self.loaded = True
+
+    def reload(self):
+        self.reloads += 1
+        self.load()
+
+    def refresh(self, interval):
+        while True:
+            time.sleep(interval)
+            self._try_reload()
+
+    def _try_reload(self):
+        try:
+            self.reload()
+        except PyMongoError as exc:
+            menu_index_log.warning("menu_items reload failed: %s", exc)
+
+    def missing(self, item_ids):
+        return [i for i in set(item_ids) if i not in self._items]
+
+    def fetch(self, item_ids):
+        self.fetches += 1
+        for doc in self.collection.find({"_id": {"$in": item_ids}}, {"price": 1, "restaurant_id": 1}):
+            self.put(doc)
+
+    def get(self, item_id):
+        return self._items.get(item_id)
+
+    def watch(self):
+        # Al reconectar retoma desde el último resume token; si el servidor ya
+        # no lo tiene, los cambios intermedios se perdieron y se recarga todo
+        self.watching = True
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        token = None
+        while True:
+            try:
+                with self.collection.watch(pipeline, full_document="updateLookup",
+                                           resume_after=token) as stream:
+                    for change in stream:
+                        if change["operationType"] == "delete":
+                            self.remove(change["documentKey"]["_id"])
+                        elif change.get("fullDocument"):
+                            self.put(change["fullDocument"])
+                        token = stream.resume_token
+            except OperationFailure as exc:
+                menu_index_log.warning("menu_items change stream failed: %s", exc)
+                if token is not None:
+                    token = None
+                    self._try_reload()
+                time.sleep(5)
+            except PyMongoError as exc:
+                menu_index_log.warning("menu_items change stream failed: %s", exc)
+                time.sleep(5)
+
+    def stats(self):
+        return {"size": len(self._items), "loaded": self.loaded,
+                "watching": self.watching, "fetches": self.fetches,
+                "reloads": self.reloads}
+
+menu_index = MenuPriceIndex(db.menu_items)
+
+@app.on_event("startup")
+def start_menu_index():
+    threading.Thread(target=menu_index.load, daemon=True).start()
+    if MENU_INDEX_WATCH:
+        threading.Thread(target=menu_index.watch, daemon=True).start()
+    elif MENU_INDEX_REFRESH > 0:
+        threading.Thread(target=menu_index.refresh, args=(MENU_INDEX_REFRESH,), daemon=True).start()
+
+def price_items(restaurant_id, items, fetch=True):
+    # Fija unit_price desde el índice y valida que cada plato sea del restaurante.
+    # fetch=False: los faltantes ya se buscaron (db_price_order) y los que
+    # siguen sin estar no existen
+    missing = menu_index.missing([it["item_id"] for it in items]) if fetch else None
+    if missing:
+        menu_index.fetch(missing)
+    for it in items:
+        entry = menu_index.get(it["item_id"])
+        if entry is None:
+            raise HTTPException(400, f"Unknown menu item {it['item_id']}")
+        if entry[1] != restaurant_id:
+            raise HTTPException(400, f"Menu item {it['item_id']} does not belong to restaurant {restaurant_id}")
+        if it["quantity"] < 1:
+            raise HTTPException(400, "quantity must be at least 1")
+        it["unit_price"] = entry[0]
+    return items
+
+def menu_restaurant(item_id):
+    if menu_index.missing([item_id]):
+        menu_index.fetch([item_id])
+    entry = menu_index.get(item_id)
+    if entry is None:
+        raise HTTPException(400, f"Unknown menu item {item_id}")
+    return entry[1]
+
+def order_total(items):
+    # float también sin items: round(0, 2) es int y el validador pide double
+    return float(round(sum(it["quantity"] * it["unit_price"] for it in items), 2))
+
+def price_order(payload, fetch=True):
+    price_items(payload["restaurant_id"], payload["items"], fetch)
+    payload["total"] = order_total(payload["items"])
+    return payload
+
+async def db_price_order(payload):
+    missing = menu_index.missing([it["item_id"] for it in payload["items"]])
+    if missing:
+        await run_in_threadpool(menu_index.fetch, missing)
+    return price_order(payload, fetch=False)
+
+# Recalcula total desde items dentro de un pipeline de actualización
+# ($toDouble: con items vacío $sum da el int 0)
+ORDER_TOTAL_STAGE = {"$set": {"total": {"$toDouble": {"$round": [{"$sum": {"$map": {
+    "input": "$items",
+    "in": {"$multiply": ["$$this.quantity", "$$this.unit_price"]}
+}}}, 2]}}}}
+
+@app.get("/admin/menu-index")
+def menu_index_stats():
+    return menu_index.stats()
+
+@app.post("/admin/menu-index/reload")
+def reload_menu_index():
+    menu_index.reload()
+    return menu_index.stats()
+
+# Agregaciones
+@app.get("/restaurants/top-rated")
+def top_rated(limit: int = 10):
+    return FastJSONResponse(response_cache.cached(
+        "top_rated", {"limit": limit},
+        lambda: single_flight.do("top_rated", limit, lambda: dumps_json(_top_rated(limit)))
+    ))
+
+def _top_rated(limit):
+    # Lectura indexada de restaurant_ratings (avgRating desc)
+    pipeline = [
+        {"$match": {"avgRating": {"$ne": None}}},
         {"$sort": {"avgRating": -1}},
         {"$limit": limit},
         {"$lookup": {
@@ -167,17 +1733,19 @@ def top_rated(limit: int = 10):
             "categories": "$restaurant_info.categories"
         }}
     ]
-    results = list(db.reviews.aggregate(pipeline))
-    return serialize_list(results)
+    return list(db.restaurant_ratings.aggregate(pipeline))
 
 @app.get("/menu-items/most-ordered")
 def most_ordered(limit: int = 10):
+    return FastJSONResponse(response_cache.cached(
+        "most_ordered", {"limit": limit},
+        lambda: single_flight.do("most_ordered", limit, lambda: dumps_json(_most_ordered(limit)))
+    ))
+
+def _most_ordered(limit):
+    # Lectura indexada de menu_item_order_counts (totalQty desc)
     pipeline = [
-        {"$unwind": "$items"},
-        {"$group": {
-            "_id": "$items.item_id",
-            "totalQty": {"$sum": "$items.quantity"}
-        }},
+        {"$match": {"totalQty": {"$gt": 0}}},
         {"$sort": {"totalQty": -1}},
         {"$limit": limit},
         {"$lookup": {
@@ -196,27 +1764,462 @@ def most_ordered(limit: int = 10):
             "restaurant_id": "$item_info.restaurant_id"
         }}
     ]
-    results = list(db.orders.aggregate(pipeline))
-    return serialize_list(results)
+    return list(db.menu_item_order_counts.aggregate(pipeline))
 
 @app.get("/reviews/count")
 def count_reviews():
-    return {"total_reviews": db.reviews.count_documents({})}
+    return FastJSONResponse(response_cache.cached(
+        "count_reviews", {},
+        lambda: dumps_json({"total_reviews": db.reviews.count_documents({})})
+    ))
 
 @app.get("/restaurants/distinct-categories")
 def distinct_categories():
-    categories = db.restaurants.distinct("categories")
-    return {"distinct_categories": categories}
+    return FastJSONResponse(response_cache.cached(
+        "distinct_categories", {},
+        lambda: dumps_json({"distinct_categories": db.restaurants.distinct("categories")})
+    ))
+
+# Restaurantes cercanos
+# $geoNear sobre el índice 2dsphere de location; la página siguiente arranca
+# en la distancia del último resultado (minDistance) y excluye los _id ya
+# devueltos a esa misma distancia
+NEARBY_MAX_RADIUS = float(os.getenv("NEARBY_MAX_RADIUS", "50000"))
+
+def nearby_pipeline(lng, lat, radius, category, cursor_payload, limit, with_rating):
+    query = {}
+    if category:
+        query["categories"] = category
+    geo = {
+        "near": {"type": "Point", "coordinates": [lng, lat]},
+        "key": "location",
+        "distanceField": "distance",
+        "maxDistance": radius,
+        "spherical": True,
+    }
+    if cursor_payload:
+        geo["minDistance"] = cursor_payload["k"]
+        query["_id"] = {"$nin": cursor_payload["ids"]}
+    geo["query"] = query
+    pipeline = [{"$geoNear": geo}, {"$limit": limit}]
+    if with_rating:
+        pipeline += [
+            {"$lookup": {
+                "from": "restaurant_ratings",
+                "localField": "_id",
+                "foreignField": "_id",
+                "as": "rating"
+            }},
+            {"$set": {
+                "avgRating": {"$arrayElemAt": ["$rating.avgRating", 0]},
+                "ratingCount": {"$arrayElemAt": ["$rating.count", 0]}
+            }},
+            {"$unset": "rating"}
+        ]
+    return pipeline
+
+def nearby_cursor(docs, cursor_payload, limit):
+    if len(docs) < limit:
+        return {}
+    last = docs[-1]["distance"]
+    ids = [doc["_id"] for doc in docs if doc["distance"] == last]
+    if cursor_payload and cursor_payload["k"] == last:
+        ids = cursor_payload["ids"] + ids
+    payload = {"s": "distance", "o": 1, "k": last, "ids": ids}
+    return {"X-Next-Cursor": base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode()}
+
+@app.get("/restaurants/nearby", response_model=List[NearbyRestaurant])
+async def nearby_restaurants(
+    response: Response,
+    lng: float = Query(..., ge=-180, le=180), lat: float = Query(..., ge=-90, le=90),
+    radius: float = Query(2000, gt=0, le=NEARBY_MAX_RADIUS, description="Metros"),
+    category: Optional[str] = Query(None),
+    with_rating: bool = Query(False),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False)
+):
+    payload = decode_cursor(cursor, "distance", 1) if cursor else None
+    pipeline = nearby_pipeline(lng, lat, radius, category, payload, limit, with_rating)
+    docs = await db_aggregate("restaurants", pipeline)
+    headers = nearby_cursor(docs, payload, limit)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [NearbyRestaurant(**doc) for doc in docs]
+
+# Búsqueda de texto
+# Por colección, un solo pipeline: $text y $facet con la página de
+# resultados, el total y los conteos por categoría/tag. Las páginas de
+# restaurants y menu_items se mezclan por score; la página siguiente es un
+# rango sobre (score, _id) igual que en los listados
+SEARCH_FACET_SIZE = int(os.getenv("SEARCH_FACET_SIZE", "10"))
+SEARCH_SOURCES = {
+    "restaurants": ("restaurant", ["name", "description", "categories", "location"], "categories"),
+    "menu_items": ("menu_item", ["name", "description", "price", "tags", "restaurant_id"], "tags"),
+}
+
+def search_pipeline(coll, q, extra, page, sort, limit):
+    kind, fields, facet = SEARCH_SOURCES[coll]
+    return [
+        {"$match": {"$text": {"$search": q}, **extra}},
+        {"$project": {
+            **{f: 1 for f in fields},
+            "type": {"$literal": kind},
+            "score": {"$meta": "textScore"}
+        }},
+        {"$facet": {
+            "results": [{"$match": page}, {"$sort": dict(sort)}, {"$limit": limit}],
+            "total": [{"$count": "n"}],
+            facet: [
+                {"$unwind": f"${facet}"},
+                {"$group": {"_id": f"${facet}", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": SEARCH_FACET_SIZE}
+            ]
+        }}
+    ]
+
+def _search(q, kind, category, tag, cursor, limit):
+    page, sort = keyset_query("score", -1, cursor)
+    filters = {
+        "restaurants": {"categories": category} if category else {},
+        "menu_items": {"tags": tag} if tag else {},
+    }
+    results, facets = [], {"types": {}}
+    for coll in (["restaurants", "menu_items"] if kind == "all" else [kind]):
+        source_kind, _, facet = SEARCH_SOURCES[coll]
+        pipeline = search_pipeline(coll, q, filters[coll], page, sort, limit)
+        result = next(db[coll].aggregate(pipeline))
+        results += result["results"]
+        facets["types"][source_kind] = result["total"][0]["n"] if result["total"] else 0
+        facets[facet] = {f["_id"]: f["count"] for f in result[facet]}
+    results = sorted(results, key=lambda d: (d["score"], d["_id"]), reverse=True)[:limit]
+    body = dumps_json({"results": results, "facets": facets})
+    return body, next_cursor_headers(results, "score", -1, limit)
+
+@app.get("/search")
+def search(
+    q: str = Query(..., min_length=1, max_length=200),
+    type: str = Query("all", pattern="^(all|restaurants|menu_items)$"),
+    category: Optional[str] = Query(None, description="Filtra los restaurantes"),
+    tag: Optional[str] = Query(None, description="Filtra los platos"),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None)
+):
+    q = " ".join(q.lower().split())
+    params = {"q": q, "type": type, "category": category, "tag": tag, "cursor": cursor, "limit": limit}
+    body, headers = search_cache.cached(
+        "search", params, lambda: _search(q, type, category, tag, cursor, limit)
+    )
+    return FastJSONResponse(body, headers=headers)
+
+# Analítica sobre restaurant_rollups
+# Las consultas por rango solo leen documentos de bucket, nunca orders/reviews
+ANALYTICS_DEFAULT_SPAN = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+
+def analytics_filter(granularity, start, end):
+    end = end or utcnow()
+    start = start or end - ANALYTICS_DEFAULT_SPAN[granularity]
+    return {"granularity": granularity, "bucket": {"$gte": start, "$lt": end}}
+
+def sales_bucket(doc):
+    return {
+        "bucket": doc["bucket"],
+        "revenue": round(doc.get("revenue", 0), 2),
+        "order_count": doc.get("order_count", 0),
+        "status": {k: v for k, v in doc.get("status", {}).items() if v},
+    }
+
+def ratings_bucket(doc):
+    count = doc.get("review_count", 0)
+    return {
+        "bucket": doc["bucket"],
+        "review_count": count,
+        "avgRating": round(doc["rating_sum"] / count, 3) if count else None,
+        "histogram": {k: v for k, v in doc.get("ratings", {}).items() if v},
+    }
+
+@app.get("/analytics/restaurants/{rid}/sales")
+async def restaurant_sales(
+    rid: str,
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    start: Optional[datetime] = Query(None), end: Optional[datetime] = Query(None),
+    items: bool = Query(False, description="Incluye la cantidad vendida por plato")
+):
+    filt = {"restaurant_id": parse_object_id(rid, "restaurant_id"),
+            **analytics_filter(granularity, start, end), "order_count": {"$ne": 0, "$exists": True}}
+    docs = await db_find("restaurant_rollups", filt, None, [("bucket", 1)])
+    buckets = []
+    for doc in docs:
+        bucket = sales_bucket(doc)
+        if items:
+            bucket["items"] = {k: v for k, v in doc.get("items", {}).items() if v}
+        buckets.append(bucket)
+    return FastJSONResponse(buckets)
+
+@app.get("/analytics/restaurants/{rid}/ratings")
+async def restaurant_ratings_trend(
+    rid: str,
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    start: Optional[datetime] = Query(None), end: Optional[datetime] = Query(None)
+):
+    filt = {"restaurant_id": parse_object_id(rid, "restaurant_id"),
+            **analytics_filter(granularity, start, end), "review_count": {"$ne": 0, "$exists": True}}
+    proj = {"bucket": 1, "review_count": 1, "rating_sum": 1, "ratings": 1}
+    docs = await db_find("restaurant_rollups", filt, proj, [("bucket", 1)])
+    return FastJSONResponse([ratings_bucket(doc) for doc in docs])
+
+@app.get("/analytics/sales")
+async def sales_overview(
+    granularity: str = Query("day", pattern="^(hour|day)$"),
+    start: Optional[datetime] = Query(None), end: Optional[datetime] = Query(None)
+):
+    # Totales de todos los restaurantes por bucket
+    docs = await db_aggregate("restaurant_rollups", [
+        {"$match": analytics_filter(granularity, start, end)},
+        {"$group": {
+            "_id": "$bucket",
+            "revenue": {"$sum": "$revenue"},
+            "order_count": {"$sum": "$order_count"},
+            "review_count": {"$sum": "$review_count"},
+            "rating_sum": {"$sum": "$rating_sum"}
+        }},
+        {"$sort": {"_id": 1}}
+    ])
+    return FastJSONResponse([{
+        "bucket": doc["_id"],
+        "revenue": round(doc["revenue"], 2),
+        "order_count": doc["order_count"],
+        "review_count": doc["review_count"],
+        "avgRating": round(doc["rating_sum"] / doc["review_count"], 3) if doc["review_count"] else None,
+    } for doc in docs])
+
+# Exportación NDJSON en streaming
+# Itera el cursor por lotes de batch_size, así la memoria no depende del
+# tamaño de la exportación
+EXPORT_MAX_BATCH_SIZE = int(os.getenv("EXPORT_MAX_BATCH_SIZE", "10000"))
+
+def ndjson_stream(cursor, batch_size, gzip_output=False):
+    compressor = zlib.compressobj(wbits=31) if gzip_output else None
+
+    def encode(lines):
+        chunk = ("\n".join(lines) + "\n").encode()
+        return compressor.compress(chunk) if compressor else chunk
+
+    try:
+        lines = []
+        for doc in cursor:
+            lines.append(json.dumps(doc, default=json_default))
+            if len(lines) >= batch_size:
+                yield encode(lines)
+                lines = []
+        if lines:
+            yield encode(lines)
+        if compressor:
+            yield compressor.flush()
+    finally:
+        cursor.close()
+
+def export_response(coll, filt, fields, batch_size, gzip_output):
+    # Sin sort: con filtro, ordenar por _id obligaría a recorrer el índice de
+    # _id o a un SORT en memoria; así el planner usa el índice del filtro
+    cursor = db[coll].find(filt, parse_fields(fields)).batch_size(batch_size)
+    filename = f"{coll}.ndjson" + (".gz" if gzip_output else "")
+    return StreamingResponse(
+        ndjson_stream(cursor, batch_size, gzip_output),
+        media_type="application/gzip" if gzip_output else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.get("/orders/export")
+def export_orders(
+    user_id: Optional[str] = Query(None), restaurant_id: Optional[str] = Query(None),
+    status: Optional[str] = Query(None),
+    created_from: Optional[datetime] = Query(None), created_to: Optional[datetime] = Query(None),
+    fields: Optional[str] = Query(None),
+    batch_size: int = Query(1000, ge=1, le=EXPORT_MAX_BATCH_SIZE),
+    gzip: bool = Query(False)
+):
+    filt = order_filters(user_id, restaurant_id, status, created_from, created_to)
+    return export_response("orders", filt, fields, batch_size, gzip)
+
+@app.get("/reviews/export")
+def export_reviews(
+    user_id: Optional[str] = Query(None), restaurant_id: Optional[str] = Query(None),
+    rating_min: Optional[int] = Query(None, ge=1, le=5), rating_max: Optional[int] = Query(None, ge=1, le=5),
+    created_from: Optional[datetime] = Query(None), created_to: Optional[datetime] = Query(None),
+    fields: Optional[str] = Query(None),
+    batch_size: int = Query(1000, ge=1, le=EXPORT_MAX_BATCH_SIZE),
+    gzip: bool = Query(False)
+):
+    filt = review_filters(user_id, restaurant_id, rating_min, rating_max, created_from, created_to)
+    return export_response("reviews", filt, fields, batch_size, gzip)
+
+# Feed de pedidos en tiempo real (SSE)
+# Un solo change stream sobre orders, en un hilo, alimenta a todos los
+# suscriptores del proceso. Los últimos eventos quedan en un buffer circular:
+# un cliente que se reconecta con Last-Event-ID (el resume token) recibe lo
+# que se perdió; si ya salió del buffer recibe "reset" y debe recargar
+ORDER_FEED_BUFFER = int(os.getenv("ORDER_FEED_BUFFER", "1000"))
+ORDER_FEED_QUEUE = int(os.getenv("ORDER_FEED_QUEUE", "1000"))
+ORDER_FEED_HEARTBEAT = float(os.getenv("ORDER_FEED_HEARTBEAT", "15"))
+# ChangeStreamHistoryLost / ChangeStreamFatalError: el token ya no sirve
+CHANGE_STREAM_LOST = (280, 286)
+
+order_feed_log = logging.getLogger("restaurant_api.order_feed")
+
+class FeedSubscriber:
+    def __init__(self, restaurant_id=None, statuses=None):
+        self.restaurant_id = restaurant_id
+        self.statuses = statuses
+        self.queue = asyncio.Queue(ORDER_FEED_QUEUE)
+        self.overflow = False
+
+    def wants(self, event):
+        # Los delete no traen documento: van a todos
+        if event["restaurant_id"] is None:
+            return True
+        if self.restaurant_id and event["restaurant_id"] != self.restaurant_id:
+            return False
+        return not self.statuses or event["status"] in self.statuses
+
+class OrderFeed:
+    def __init__(self, collection, buffer_size):
+        self.collection = collection
+        # buffer y subscribers solo se tocan desde el event loop
+        self.buffer = deque(maxlen=buffer_size)
+        self.subscribers = set()
+        self.resume_token = None
+        self.loop = None
+        self.events = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self, loop):
+        with self._lock:
+            if self._thread is None:
+                self.loop = loop
+                self._thread = threading.Thread(target=self.run, daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                with self.collection.watch(full_document="updateLookup",
+                                           resume_after=self.resume_token) as stream:
+                    for change in stream:
+                        self.publish(change)
+            except OperationFailure as exc:
+                order_feed_log.warning("orders change stream failed: %s", exc)
+                if exc.code in CHANGE_STREAM_LOST:
+                    self.resume_token = None
+                    self.loop.call_soon_threadsafe(self.buffer.clear)
+                time.sleep(5)
+            except PyMongoError as exc:
+                order_feed_log.warning("orders change stream failed: %s", exc)
+                time.sleep(5)
+
+    def publish(self, change):
+        # Corre en el hilo del change stream; serializa una sola vez por evento
+        doc = change.get("fullDocument")
+        event = {
+            "id": change["_id"]["_data"],
+            "restaurant_id": str(doc["restaurant_id"]) if doc else None,
+            "status": doc.get("status") if doc else None,
+            "data": dumps_json({
+                "op": change["operationType"],
+                "order_id": change["documentKey"]["_id"],
+                "order": doc
+            }).decode()
+        }
+        self.resume_token = change["_id"]
+        metrics.inc("order_feed_events_total", "Eventos del change stream de orders",
+                    {"op": change["operationType"]})
+        self.loop.call_soon_threadsafe(self.dispatch, event)
+
+    def dispatch(self, event):
+        self.buffer.append(event)
+        self.events += 1
+        for sub in list(self.subscribers):
+            if not sub.wants(event):
+                continue
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Cliente lento: se corta y al reconectar recupera desde el buffer
+                sub.overflow = True
+                self.subscribers.discard(sub)
+
+    def subscribe(self, sub, last_event_id=None):
+        # Registro y copia del buffer sin await de por medio: ni huecos ni duplicados
+        self.subscribers.add(sub)
+        if not last_event_id:
+            return []
+        ids = [e["id"] for e in self.buffer]
+        if last_event_id not in ids:
+            return None
+        return [e for e in list(self.buffer)[ids.index(last_event_id) + 1:] if sub.wants(e)]
+
+    def stats(self):
+        return {"running": self._thread is not None, "subscribers": len(self.subscribers),
+                "buffered": len(self.buffer), "events": self.events}
+
+order_feed = OrderFeed(db.orders, ORDER_FEED_BUFFER)
+
+def sse_event(event):
+    return f"id: {event['id']}\nevent: order\ndata: {event['data']}\n\n"
+
+async def order_feed_stream(sub, replay):
+    try:
+        yield "retry: 3000\n\n"
+        if replay is None:
+            yield "event: reset\ndata: {}\n\n"
+        else:
+            for event in replay:
+                yield sse_event(event)
+        while not sub.overflow:
+            try:
+                event = await asyncio.wait_for(sub.queue.get(), ORDER_FEED_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            yield sse_event(event)
+    finally:
+        order_feed.subscribers.discard(sub)
+
+@app.get("/orders/feed")
+async def orders_feed(
+    restaurant_id: Optional[str] = Query(None),
+    status: Optional[str] = Query(None, description="Lista separada por comas"),
+    last_event_id: Optional[str] = Header(None)
+):
+    if restaurant_id:
+        restaurant_id = str(parse_object_id(restaurant_id, "restaurant_id"))
+    statuses = set(status.split(",")) if status else None
+    order_feed.ensure_started(asyncio.get_running_loop())
+    sub = FeedSubscriber(restaurant_id, statuses)
+    replay = order_feed.subscribe(sub, last_event_id)
+    return StreamingResponse(
+        order_feed_stream(sub, replay),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/admin/order-feed")
+def order_feed_stats():
+    return order_feed.stats()
 
 # Cruds de VARIOS 
 @app.post("/users/batch-create", response_model=List[User], status_code=201)
 def batch_create_users(users: List[User]):
     payload = [u.dict(by_alias=True, exclude={"id", "created_at"}) for u in users]
     for p in payload:
-        p["created_at"] = datetime.utcnow()
+        p["created_at"] = utcnow()
     res = db.users.insert_many(payload)
-    docs = list(db.users.find({"_id": {"$in": res.inserted_ids}}))
-    return [User(**doc) for doc in docs]
+    for p, inserted_id in zip(payload, res.inserted_ids):
+        p["_id"] = inserted_id
+    return [User(**p) for p in payload]
 
 @app.patch("/orders/batch-update")
 def batch_update_orders_by_ids(
@@ -224,10 +2227,16 @@ def batch_update_orders_by_ids(
     new_status: str = Body(..., example="completed")
 ):
     obj_ids = [ObjectId(oid) for oid in order_ids]
+    # El status cuenta para user_stats: se leen los documentos previos
+    before = list(db.orders.find({"_id": {"$in": obj_ids}, "status": {"$ne": new_status}}))
     result = db.orders.update_many(
         {"_id": {"$in": obj_ids}},
         {"$set": {"status": new_status}}
     )
+    write_projections(collect_projections(
+        order_projection_ops, [(doc, {**doc, "status": new_status}) for doc in before]
+    ))
+    invalidate_cache("orders")
     return {
         "matched": result.matched_count,
         "modified": result.modified_count
@@ -239,6 +2248,127 @@ def batch_delete_users(user_ids: List[str] = Body(...)):
     obj_ids = [ObjectId(uid) for uid in user_ids]
     result = db.users.delete_many({"_id": {"$in": obj_ids}})
     return {"deleted_count": result.deleted_count}
+
+# Escrituras en lote (sync de terminales POS)
+# Cada operación se valida por separado y los errores se informan por índice
+# sin frenar el resto. Por chunk: una lectura $in de los documentos previos
+# (para las proyecciones), un bulk_write unordered y un bulk_write por
+# proyección
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_MAX_OPERATIONS = int(os.getenv("BULK_MAX_OPERATIONS", "10000"))
+
+class BulkOperation(BaseModel):
+    # insert: como POST; update: como PUT (el documento debe existir);
+    # upsert: como PUT, creándolo si no existe
+    op: str = Field("insert", pattern="^(insert|update|upsert)$")
+    id: Optional[str] = None
+    doc: dict
+
+def bulk_payload(model, operation, stamped, prepare=None):
+    if operation.op != "insert" and not operation.id:
+        raise ValueError("id is required for update/upsert")
+    if operation.id and not ObjectId.is_valid(operation.id):
+        raise ValueError("Invalid id")
+    _id = ObjectId(operation.id) if operation.id else ObjectId()
+    exclude = {"id", "created_at"} if stamped else {"id"}
+    payload = model(**operation.doc).dict(by_alias=True, exclude=exclude)
+    return _id, prepare(payload) if prepare else payload
+
+def bulk_apply(coll, model, operations, projection_ops=None, stamped=True, prepare=None, on_write=None):
+    if len(operations) > BULK_MAX_OPERATIONS:
+        raise HTTPException(400, f"At most {BULK_MAX_OPERATIONS} operations per request")
+    summary = {"inserted": 0, "updated": 0, "upserted": 0, "ids": [None] * len(operations), "errors": []}
+    # Un mismo _id dos veces en el request usaría el mismo documento previo
+    # para las dos deltas (y el orden en un bulk unordered no está garantizado):
+    # solo vale la primera aparición
+    seen = set()
+    for start in range(0, len(operations), BULK_CHUNK_SIZE):
+        items = []
+        for i, operation in enumerate(operations[start:start + BULK_CHUNK_SIZE], start):
+            try:
+                item = (i, operation.op) + bulk_payload(model, operation, stamped, prepare)
+                if item[2] in seen:
+                    raise ValueError("duplicate id in request")
+                seen.add(item[2])
+                items.append(item)
+            except (ValueError, ValidationError) as exc:
+                summary["errors"].append({"index": i, "error": str(exc)})
+            except HTTPException as exc:
+                summary["errors"].append({"index": i, "error": exc.detail})
+
+        ids = [_id for _, op, _id, _ in items if op != "insert"]
+        before = {d["_id"]: d for d in db[coll].find({"_id": {"$in": ids}})} if ids else {}
+        now = utcnow()
+        requests, sent = [], []
+        for i, op, _id, payload in items:
+            if op == "update" and _id not in before:
+                summary["errors"].append({"index": i, "error": "not found"})
+                continue
+            if op == "insert":
+                doc = {"_id": _id, **payload}
+                if stamped:
+                    doc["created_at"] = now
+                requests.append(InsertOne(doc))
+            else:
+                update = {"$set": payload}
+                if stamped:
+                    update["$setOnInsert"] = {"created_at": now}
+                requests.append(UpdateOne({"_id": _id}, update, upsert=op == "upsert"))
+            sent.append((i, op, _id, payload))
+
+        failed = {}
+        if requests:
+            try:
+                db[coll].bulk_write(requests, ordered=False)
+            except BulkWriteError as exc:
+                failed = {e["index"]: e["errmsg"] for e in exc.details["writeErrors"]}
+
+        pairs = []
+        for n, (i, op, _id, payload) in enumerate(sent):
+            if n in failed:
+                summary["errors"].append({"index": i, "error": failed[n]})
+                continue
+            prev = before.get(_id)
+            if prev is None:
+                summary["inserted" if op == "insert" else "upserted"] += 1
+                after = {"_id": _id, **payload, **({"created_at": now} if stamped else {})}
+            else:
+                summary["updated"] += 1
+                after = {**prev, **payload}
+            summary["ids"][i] = str(_id)
+            if on_write:
+                on_write(prev, after)
+            pairs.append((prev, after))
+        if projection_ops:
+            write_projections(collect_projections(projection_ops, pairs))
+    invalidate_cache(coll)
+    summary["errors"].sort(key=lambda e: e["index"])
+    return summary
+
+def menu_item_written(doc):
+    single_flight.forget("get_menu_item", str(doc["_id"]))
+    menu_index.put(doc)
+
+@app.post("/orders/bulk")
+def bulk_orders(operations: List[BulkOperation] = Body(...)):
+    return bulk_apply("orders", Order, operations, order_projection_ops, prepare=price_order)
+
+@app.post("/menu-items/bulk")
+def bulk_menu_items(operations: List[BulkOperation] = Body(...)):
+    # Cada menú afectado se rearma una sola vez al final del lote
+    touched = set()
+
+    def on_write(prev, after):
+        menu_item_written(after)
+        touched.update(menu_restaurants(prev, after))
+    summary = bulk_apply("menu_items", MenuItem, operations, stamped=False, on_write=on_write)
+    rebuild_menus(touched)
+    return summary
+
+@app.post("/reviews/bulk")
+def bulk_reviews(operations: List[BulkOperation] = Body(...)):
+    return bulk_apply("reviews", Review, operations, review_projection_ops)
+
 # Root
 @app.get("/")
 def root():
@@ -246,38 +2376,76 @@ def root():
 
 # CRUD Restaurants
 @app.get("/restaurants", response_model=List[Restaurant])
-def list_restaurants(
+async def list_restaurants(
+    response: Response,
     sort_by: str = Query("name"), order: int = Query(1),
     fields: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100)
+    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False),
+    ids: Optional[str] = Query(None, description="Lista separada por comas; ignora filtros y paginación"),
 ):
-    proj = parse_fields(fields)
-    cursor = db.restaurants.find({}, proj)\
-        .sort(sort_by, order).skip(skip).limit(limit)
-    return [Restaurant(**doc) for doc in cursor]
+    if ids:
+        docs = await multi_get("restaurants", ids, parse_fields(fields))
+        return FastJSONResponse(docs) if fast else [Restaurant(**doc) for doc in docs]
+    sort_by, order, fallback = await db_check_query("restaurants", {}, sort_by, order, ("name", 1))
+    proj = with_sort_field(parse_fields(fields), sort_by)
+    filt, sort = keyset_query(sort_by, order, cursor, skip)
+    docs = await db_find("restaurants", filt, proj, sort, skip, limit)
+    headers = sort_fallback_headers(next_cursor_headers(docs, sort_by, order, limit), fallback, sort_by, order)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [Restaurant(**doc) for doc in docs]
 
 @app.post("/restaurants", response_model=Restaurant, status_code=201)
-def create_restaurant(rest: Restaurant):
+async def create_restaurant(rest: Restaurant):
     payload = rest.dict(by_alias=True, exclude={"id"})
-    res = db.restaurants.insert_one(payload)
-    doc = db.restaurants.find_one({"_id": res.inserted_id})
-    return Restaurant(**doc)
+    res = await db_call("restaurants", "insert_one", payload)
+    await db_invalidate_cache("restaurants")
+    payload["_id"] = res.inserted_id
+    return Restaurant(**payload)
 
 @app.get("/restaurants/{rid}", response_model=Restaurant)
-def get_restaurant(rid: str):
-    doc = db.restaurants.find_one({"_id": ObjectId(rid)})
+async def get_restaurant(rid: str):
+    doc = await single_flight.do_async(
+        "get_restaurant", rid, lambda: db_call("restaurants", "find_one", {"_id": ObjectId(rid)})
+    )
     if not doc:
         raise HTTPException(404, "Restaurant not found")
     return Restaurant(**doc)
 
+async def load_menu(restaurant_id):
+    doc = await db_call("restaurant_menus", "find_one", {"_id": restaurant_id}, MENU_INTERNAL_FIELDS)
+    if doc is None or "etag" not in doc:
+        # Primera lectura del restaurante (o su primer rearmado sigue en curso)
+        doc = await run_in_threadpool(build_menu, restaurant_id)
+    return doc
+
+@app.get("/restaurants/{rid}/menu")
+async def get_restaurant_menu(rid: str, if_none_match: Optional[str] = Header(None)):
+    restaurant_id = parse_object_id(rid)
+    doc = await single_flight.do_async("get_restaurant_menu", rid, lambda: load_menu(restaurant_id))
+    if not doc:
+        raise HTTPException(404, "Restaurant not found")
+    headers = {"ETag": doc["etag"], "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, doc["etag"]):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(doc, headers=headers)
+
 @app.put("/restaurants/{rid}", response_model=Restaurant)
 def update_restaurant(rid: str, rest: Restaurant):
     payload = rest.dict(by_alias=True, exclude={"id"})
-    db.restaurants.update_one(
+    doc = db.restaurants.find_one_and_update(
         {"_id": ObjectId(rid)},
-        {"$set": payload}
+        {"$set": payload},
+        return_document=ReturnDocument.AFTER
     )
-    doc = db.restaurants.find_one({"_id": ObjectId(rid)})
+    if not doc:
+        raise HTTPException(404, "Restaurant not found")
+    single_flight.forget("get_restaurant", rid)
+    rebuild_menus([doc["_id"]])
+    invalidate_cache("restaurants")
     return Restaurant(**doc)
 
 @app.delete("/restaurants/{rid}", response_model=None)
@@ -285,48 +2453,104 @@ def delete_restaurant(rid: str):
     result = db.restaurants.delete_one({"_id": ObjectId(rid)})
     if result.deleted_count == 0:
         raise HTTPException(404, "Restaurant not found")
+    single_flight.forget("get_restaurant", rid)
+    rebuild_menus([ObjectId(rid)])
+    invalidate_cache("restaurants")
     return JSONResponse(status_code=200, content={"message": "Deleted successfully"})
 
 
 # CRUD Users
 @app.get("/users", response_model=List[User])
-def list_users(
+async def list_users(
+    response: Response,
     sort_by: str = Query("created_at"), order: int = Query(-1),
     fields: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100)
+    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False),
+    ids: Optional[str] = Query(None, description="Lista separada por comas; ignora filtros y paginación"),
 ):
-    proj = parse_fields(fields)
-    cursor = db.users.find({}, proj)\
-        .sort(sort_by, order).skip(skip).limit(limit)
-    return [User(**u) for u in cursor]
+    if ids:
+        docs = await multi_get("users", ids, parse_fields(fields))
+        return FastJSONResponse(docs) if fast else [User(**u) for u in docs]
+    sort_by, order, fallback = await db_check_query("users", {}, sort_by, order, ("created_at", -1))
+    proj = with_sort_field(parse_fields(fields), sort_by)
+    filt, sort = keyset_query(sort_by, order, cursor, skip)
+    docs = await db_find("users", filt, proj, sort, skip, limit)
+    headers = sort_fallback_headers(next_cursor_headers(docs, sort_by, order, limit), fallback, sort_by, order)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [User(**u) for u in docs]
 
 @app.post("/users", response_model=User, status_code=201)
-def create_user(user: User):
+async def create_user(user: User):
     payload = user.dict(by_alias=True, exclude={"id", "created_at"})
-    payload["created_at"] = datetime.utcnow()
+    payload["created_at"] = utcnow()
     try:
-        res = db.users.insert_one(payload)
+        res = await db_call("users", "insert_one", payload)
     except DuplicateKeyError:
-        existing = db.users.find_one({"email": payload["email"]})
+        existing = await db_call("users", "find_one", {"email": payload["email"]})
         return User(**existing)
-    doc = db.users.find_one({"_id": res.inserted_id})
-    return User(**doc)
+    payload["_id"] = res.inserted_id
+    return User(**payload)
 
 @app.get("/users/{uid}", response_model=User)
-def get_user(uid: str):
-    doc = db.users.find_one({"_id": ObjectId(uid)})
+async def get_user(uid: str):
+    doc = await db_call("users", "find_one", {"_id": ObjectId(uid)})
     if not doc:
         raise HTTPException(404, "User not found")
     return User(**doc)
 
+@app.get("/users/{uid}/orders", response_model=List[Order])
+async def list_user_orders(
+    uid: str,
+    response: Response,
+    status: Optional[str] = Query(None),
+    created_from: Optional[datetime] = Query(None), created_to: Optional[datetime] = Query(None),
+    fields: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False)
+):
+    # Índice (user_id, created_at, _id): cada página es un rango del índice
+    filt = order_filters(uid, None, status, created_from, created_to)
+    proj = with_sort_field(parse_fields(fields), "created_at")
+    page, sort = keyset_query("created_at", -1, cursor)
+    docs = await db_find("orders", {**filt, **page}, proj, sort, 0, limit)
+    headers = next_cursor_headers(docs, "created_at", -1, limit)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [Order(**o) for o in docs]
+
+@app.get("/users/{uid}/stats")
+async def get_user_stats(uid: str):
+    user_id = parse_object_id(uid, "user_id")
+    stats = await db_call("user_stats", "find_one", {"_id": user_id})
+    if stats is None:
+        # Sin pedidos ni reseñas todavía
+        if not await db_call("users", "find_one", {"_id": user_id}, {"_id": 1}):
+            raise HTTPException(404, "User not found")
+        stats = {"order_count": 0, "spend": 0, "review_count": 0, "avgRating": None}
+    return {
+        "user_id": uid,
+        "order_count": stats.get("order_count", 0),
+        "spend": stats.get("spend", 0),
+        "review_count": stats.get("review_count", 0),
+        "avgRating": stats.get("avgRating"),
+    }
+
 @app.put("/users/{uid}", response_model=User)
 def update_user(uid: str, user: User):
     payload = user.dict(by_alias=True, exclude={"id", "created_at"})
-    db.users.update_one(
+    doc = db.users.find_one_and_update(
         {"_id": ObjectId(uid)},
-        {"$set": payload}
+        {"$set": payload},
+        return_document=ReturnDocument.AFTER
     )
-    doc = db.users.find_one({"_id": ObjectId(uid)})
+    if not doc:
+        raise HTTPException(404, "User not found")
     return User(**doc)
 
 @app.delete("/users/{uid}", response_model=None)
@@ -338,26 +2562,47 @@ def delete_user(uid: str):
 
 # CRUD MenuItems
 @app.get("/menu-items", response_model=List[MenuItem])
-def list_menu_items(
+async def list_menu_items(
+    response: Response,
     sort_by: str = Query("name"), order: int = Query(1),
     fields: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100)
+    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False),
+    restaurant_id: Optional[str] = Query(None),
+    tags: Optional[str] = Query(None, description="Lista separada por comas; el plato debe tener todos"),
+    ids: Optional[str] = Query(None, description="Lista separada por comas; ignora filtros y paginación"),
 ):
+    if ids:
+        docs = await multi_get("menu_items", ids, parse_fields(fields))
+        return FastJSONResponse(docs) if fast else [MenuItem(**m) for m in docs]
+    filt = menu_item_filters(restaurant_id, tags)
     proj = parse_fields(fields)
-    cursor = db.menu_items.find({}, proj)\
-        .sort(sort_by, order).skip(skip).limit(limit)
-    return [MenuItem(**m) for m in cursor]
+    sort_by, order, fallback = await db_check_query("menu_items", filt, sort_by, order, ("name", 1), proj)
+    proj = with_sort_field(proj, sort_by)
+    page, sort = keyset_query(sort_by, order, cursor, skip)
+    docs = await db_find("menu_items", {**filt, **page}, proj, sort, skip, limit)
+    headers = sort_fallback_headers(next_cursor_headers(docs, sort_by, order, limit), fallback, sort_by, order)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [MenuItem(**m) for m in docs]
 
 @app.post("/menu-items", response_model=MenuItem, status_code=201)
-def create_menu_item(item: MenuItem):
+async def create_menu_item(item: MenuItem):
     payload = item.dict(by_alias=True, exclude={"id"})
-    res = db.menu_items.insert_one(payload)
-    doc = db.menu_items.find_one({"_id": res.inserted_id})
-    return MenuItem(**doc)
+    res = await db_call("menu_items", "insert_one", payload)
+    payload["_id"] = res.inserted_id
+    menu_index.put(payload)
+    await run_in_threadpool(rebuild_menus, menu_restaurants(payload))
+    await db_invalidate_cache("menu_items")
+    return MenuItem(**payload)
 
 @app.get("/menu-items/{mid}", response_model=MenuItem)
-def get_menu_item(mid: str):
-    doc = db.menu_items.find_one({"_id": ObjectId(mid)})
+async def get_menu_item(mid: str):
+    doc = await single_flight.do_async(
+        "get_menu_item", mid, lambda: db_call("menu_items", "find_one", {"_id": ObjectId(mid)})
+    )
     if not doc:
         raise HTTPException(404, "MenuItem not found")
     return MenuItem(**doc)
@@ -365,145 +2610,426 @@ def get_menu_item(mid: str):
 @app.put("/menu-items/{mid}", response_model=MenuItem)
 def update_menu_item(mid: str, item: MenuItem):
     payload = item.dict(by_alias=True, exclude={"id"})
-    db.menu_items.update_one(
+    # El documento previo dice de qué restaurante sale el plato si cambia
+    before = db.menu_items.find_one_and_update(
         {"_id": ObjectId(mid)},
         {"$set": payload}
     )
-    doc = db.menu_items.find_one({"_id": ObjectId(mid)})
+    if not before:
+        raise HTTPException(404, "MenuItem not found")
+    doc = {**before, **payload}
+    menu_item_written(doc)
+    rebuild_menus(menu_restaurants(before, doc))
+    invalidate_cache("menu_items")
     return MenuItem(**doc)
 
 @app.delete("/menu-items/{mid}", response_model=None)
 def delete_menu_item(mid: str):
-    result = db.menu_items.delete_one({"_id": ObjectId(mid)})
-    if result.deleted_count == 0:
+    doc = db.menu_items.find_one_and_delete({"_id": ObjectId(mid)})
+    if not doc:
         raise HTTPException(status_code=404, detail="Menu item not found")
+    single_flight.forget("get_menu_item", mid)
+    menu_index.remove(ObjectId(mid))
+    rebuild_menus(menu_restaurants(doc))
+    invalidate_cache("menu_items")
     return JSONResponse(status_code=200, content={"message": "Deleted successfully"})
 
 # CRUD Orders
 @app.get("/orders", response_model=List[Order])
-def list_orders(
+async def list_orders(
+    response: Response,
     sort_by: str = Query("created_at"), order: int = Query(-1),
     fields: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100)
+    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False),
+    user_id: Optional[str] = Query(None), restaurant_id: Optional[str] = Query(None),
+    status: Optional[str] = Query(None),
+    created_from: Optional[datetime] = Query(None), created_to: Optional[datetime] = Query(None),
+    ids: Optional[str] = Query(None, description="Lista separada por comas; ignora filtros y paginación"),
+    expand: Optional[str] = Query(None, description="Lista separada por comas: user,restaurant,items"),
 ):
-    proj = parse_fields(fields)
-    cursor = db.orders.find({}, proj)\
-        .sort(sort_by, order).skip(skip).limit(limit)
-    return [Order(**o) for o in cursor]
+    names = parse_expand("orders", expand)
+    proj = with_expand_fields(parse_fields(fields), "orders", names)
+    if ids:
+        docs, headers = await multi_get("orders", ids, proj), {}
+    else:
+        filt = order_filters(user_id, restaurant_id, status, created_from, created_to)
+        sort_by, order, fallback = await db_check_query("orders", filt, sort_by, order, ("created_at", -1), proj)
+        proj = with_sort_field(proj, sort_by)
+        page, sort = keyset_query(sort_by, order, cursor, skip)
+        docs = await db_find("orders", {**filt, **page}, proj, sort, skip, limit)
+        headers = sort_fallback_headers(next_cursor_headers(docs, sort_by, order, limit), fallback, sort_by, order)
+    if names:
+        # Los documentos expandidos no entran en el modelo: siempre por la ruta rápida
+        return FastJSONResponse(await expand_docs("orders", docs, names), headers=headers)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [Order(**o) for o in docs]
 
 @app.post("/orders", response_model=Order, status_code=201)
-def create_order(order: Order):
-    payload = order.dict(by_alias=True, exclude={"id", "created_at"})
-    payload["created_at"] = datetime.utcnow()
-    res = db.orders.insert_one(payload)
-    doc = db.orders.find_one({"_id": res.inserted_id})
-    return Order(**doc)
+async def create_order(order: Order):
+    payload = await db_price_order(order.dict(by_alias=True, exclude={"id", "created_at"}))
+    payload["created_at"] = utcnow()
+    res = await db_call("orders", "insert_one", payload)
+    await db_write_projections(order_projection_ops(None, payload))
+    await db_invalidate_cache("orders")
+    payload["_id"] = res.inserted_id
+    return Order(**payload)
 
 @app.get("/orders/{oid}", response_model=Order)
-def get_order(oid: str):
-    doc = db.orders.find_one({"_id": ObjectId(oid)})
+async def get_order(oid: str, expand: Optional[str] = Query(None, description="Lista separada por comas: user,restaurant,items")):
+    names = parse_expand("orders", expand)
+    doc = await db_call("orders", "find_one", {"_id": ObjectId(oid)})
     if not doc:
         raise HTTPException(404, "Order not found")
+    if names:
+        return FastJSONResponse((await expand_docs("orders", [doc], names))[0])
     return Order(**doc)
 
 @app.put("/orders/{oid}", response_model=Order)
 def update_order(oid: str, order: Order):
-    payload = order.dict(by_alias=True, exclude={"id", "created_at"})
-    db.orders.update_one(
+    payload = price_order(order.dict(by_alias=True, exclude={"id", "created_at"}))
+    before = db.orders.find_one_and_update(
         {"_id": ObjectId(oid)},
-        {"$set": payload}
+        {"$set": payload},
+        return_document=ReturnDocument.BEFORE
     )
-    doc = db.orders.find_one({"_id": ObjectId(oid)})
+    if not before:
+        raise HTTPException(404, "Order not found")
+    doc = {**before, **payload}
+    write_projections(order_projection_ops(before, doc))
+    invalidate_cache("orders")
     return Order(**doc)
 
 @app.delete("/orders/{oid}", response_model=None)
 def delete_order(oid: str):
-    result = db.orders.delete_one({"_id": ObjectId(oid)})
-    if result.deleted_count == 0:
+    doc = db.orders.find_one_and_delete({"_id": ObjectId(oid)})
+    if not doc:
         raise HTTPException(status_code=404, detail="Order not found")
+    write_projections(order_projection_ops(doc, None))
+    invalidate_cache("orders")
     return JSONResponse(status_code=200, content={"message": "Deleted successfully"})
 
 # CRUD Reviews
 @app.get("/reviews", response_model=List[Review])
-def list_reviews(
+async def list_reviews(
+    response: Response,
     sort_by: str = Query("created_at"), order: int = Query(-1),
     fields: Optional[str] = Query(None),
-    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100)
+    skip: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    fast: bool = Query(False),
+    user_id: Optional[str] = Query(None), restaurant_id: Optional[str] = Query(None),
+    rating_min: Optional[int] = Query(None, ge=1, le=5), rating_max: Optional[int] = Query(None, ge=1, le=5),
+    created_from: Optional[datetime] = Query(None), created_to: Optional[datetime] = Query(None),
+    ids: Optional[str] = Query(None, description="Lista separada por comas; ignora filtros y paginación"),
+    expand: Optional[str] = Query(None, description="Lista separada por comas: user,restaurant,order"),
 ):
-    proj = parse_fields(fields)
-    cursor = db.reviews.find({}, proj)\
-        .sort(sort_by, order).skip(skip).limit(limit)
-    return [Review(**r) for r in cursor]
+    names = parse_expand("reviews", expand)
+    proj = with_expand_fields(parse_fields(fields), "reviews", names)
+    if ids:
+        docs, headers = await multi_get("reviews", ids, proj), {}
+    else:
+        filt = review_filters(user_id, restaurant_id, rating_min, rating_max, created_from, created_to)
+        sort_by, order, fallback = await db_check_query("reviews", filt, sort_by, order, ("created_at", -1), proj)
+        proj = with_sort_field(proj, sort_by)
+        page, sort = keyset_query(sort_by, order, cursor, skip)
+        docs = await db_find("reviews", {**filt, **page}, proj, sort, skip, limit)
+        headers = sort_fallback_headers(next_cursor_headers(docs, sort_by, order, limit), fallback, sort_by, order)
+    if names:
+        # Los documentos expandidos no entran en el modelo: siempre por la ruta rápida
+        return FastJSONResponse(await expand_docs("reviews", docs, names), headers=headers)
+    if fast:
+        return FastJSONResponse(docs, headers=headers)
+    response.headers.update(headers)
+    return [Review(**r) for r in docs]
 
 @app.post("/reviews", response_model=Review, status_code=201)
-def create_review(review: Review):
+async def create_review(review: Review):
     payload = review.dict(by_alias=True, exclude={"id", "created_at"})
-    payload["created_at"] = datetime.utcnow()
-    res = db.reviews.insert_one(payload)
-    doc = db.reviews.find_one({"_id": res.inserted_id})
-    return Review(**doc)
+    payload["created_at"] = utcnow()
+    res = await db_call("reviews", "insert_one", payload)
+    await db_write_projections(review_projection_ops(None, payload))
+    await db_invalidate_cache("reviews")
+    payload["_id"] = res.inserted_id
+    return Review(**payload)
 
 @app.get("/reviews/{rid}", response_model=Review)
-def get_review(rid: str):
-    doc = db.reviews.find_one({"_id": ObjectId(rid)})
+async def get_review(rid: str, expand: Optional[str] = Query(None, description="Lista separada por comas: user,restaurant,order")):
+    names = parse_expand("reviews", expand)
+    doc = await db_call("reviews", "find_one", {"_id": ObjectId(rid)})
     if not doc:
         raise HTTPException(404, "Review not found")
+    if names:
+        return FastJSONResponse((await expand_docs("reviews", [doc], names))[0])
     return Review(**doc)
 
 @app.put("/reviews/{rid}", response_model=Review)
 def update_review(rid: str, review: Review):
     payload = review.dict(by_alias=True, exclude={"id", "created_at"})
-    db.reviews.update_one(
+    before = db.reviews.find_one_and_update(
         {"_id": ObjectId(rid)},
-        {"$set": payload}
+        {"$set": payload},
+        return_document=ReturnDocument.BEFORE
     )
-    doc = db.reviews.find_one({"_id": ObjectId(rid)})
+    if not before:
+        raise HTTPException(404, "Review not found")
+    doc = {**before, **payload}
+    write_projections(review_projection_ops(before, doc))
+    invalidate_cache("reviews")
     return Review(**doc)
 
 @app.delete("/reviews/{rid}", response_model=None)
 def delete_review(rid: str):
-    result = db.reviews.delete_one({"_id": ObjectId(rid)})
-    if result.deleted_count == 0:
+    doc = db.reviews.find_one_and_delete({"_id": ObjectId(rid)})
+    if not doc:
         raise HTTPException(status_code=404, detail="Review not found")
+    write_projections(review_projection_ops(doc, None))
+    invalidate_cache("reviews")
     return JSONResponse(status_code=200, content={"message": "Deleted successfully"})
 
 # push y pull
 @app.patch("/orders/{oid}/add-item", response_model=None)
 def add_item_to_order(oid: str, item: OrderItem = Body(...)):
-    result = db.orders.update_one(
-        {"_id": ObjectId(oid)},
-        {"$push": {"items": item.dict()}}
+    new_item = item.dict()
+    # El filtro por restaurant_id valida el plato contra el pedido en la misma escritura
+    restaurant_id = menu_restaurant(new_item["item_id"])
+    price_items(restaurant_id, [new_item])
+    before = db.orders.find_one_and_update(
+        {"_id": ObjectId(oid), "restaurant_id": restaurant_id},
+        [
+            {"$set": {"items": {"$concatArrays": [{"$ifNull": ["$items", []]}, [new_item]]}}},
+            ORDER_TOTAL_STAGE
+        ],
+        return_document=ReturnDocument.BEFORE
     )
-    if result.matched_count == 0:
+    if not before:
+        if db.orders.count_documents({"_id": ObjectId(oid)}, limit=1):
+            raise HTTPException(400, "Menu item belongs to another restaurant")
         raise HTTPException(404, "Order not found")
+    after = {**before, "items": before.get("items", []) + [new_item]}
+    after["total"] = order_total(after["items"])
+    write_projections(order_projection_ops(before, after))
+    invalidate_cache("orders")
     return JSONResponse(status_code=200, content={"message": "Item added to order successfully"})
 
 @app.patch("/orders/{oid}/remove-item/{item_id}", response_model=None)
 def remove_item_from_order(oid: str, item_id: str):
-    result = db.orders.update_one(
+    before = db.orders.find_one_and_update(
         {"_id": ObjectId(oid)},
-        {"$pull": {"items": {"item_id": ObjectId(item_id)}}}
+        [
+            {"$set": {"items": {"$filter": {
+                "input": {"$ifNull": ["$items", []]},
+                "cond": {"$ne": ["$$this.item_id", ObjectId(item_id)]}
+            }}}},
+            ORDER_TOTAL_STAGE
+        ],
+        return_document=ReturnDocument.BEFORE
     )
-    if result.matched_count == 0:
+    if not before:
         raise HTTPException(404, "Order not found")
+    after = {**before, "items": [
+        it for it in before.get("items", []) if it["item_id"] != ObjectId(item_id)
+    ]}
+    after["total"] = order_total(after["items"])
+    write_projections(order_projection_ops(before, after))
+    invalidate_cache("orders")
     return JSONResponse(status_code=200, content={"message": "Item removed from order successfully"})
 
 # GridFS subir y descargar archivos
+# Subida y descarga por chunks: la memoria usada no depende del tamaño de la imagen
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", str(255 * 1024)))
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", "86400"))
+
 @app.post("/restaurants/{rid}/upload-image")
 async def upload_image(rid: str, file: UploadFile = File(...)):
-    data = await file.read()
-    file_id = fs.put(
-        data,
+    grid_in = fs.new_file(
         filename=file.filename,
         contentType=file.content_type,
+        chunkSize=IMAGE_CHUNK_SIZE,
         metadata={"restaurant_id": ObjectId(rid)}
     )
-    return {"file_id": str(file_id)}
+    try:
+        while True:
+            chunk = await file.read(IMAGE_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(grid_in.write, chunk)
+        await run_in_threadpool(grid_in.close)
+    except Exception:
+        await run_in_threadpool(grid_in.abort)
+        raise
+    return {"file_id": str(grid_in._id)}
+
+def image_etag(grid_out):
+    if grid_out.md5:
+        return f'"{grid_out.md5}"'
+    return f'"{grid_out._id}-{int(grid_out.upload_date.timestamp())}-{grid_out.length}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def parse_range(range_header, length):
+    # Solo se soporta un rango "bytes=inicio-fin"; cualquier otro se ignora
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start, _, end = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start == "":
+            start, end = max(length - int(end), 0), length - 1
+        else:
+            start, end = int(start), (int(end) if end else length - 1)
+    except ValueError:
+        return None
+    if start >= length or start > end:
+        raise HTTPException(416, "Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{length}"})
+    return start, min(end, length - 1)
+
+def gridfs_stream(grid_out, start, end):
+    try:
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = grid_out.read(min(grid_out.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        grid_out.close()
+
+def stream_grid_out(grid_out, range_header=None, if_none_match=None):
+    etag = image_etag(grid_out)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if etag_matches(if_none_match, etag):
+        grid_out.close()
+        return Response(status_code=304, headers=headers)
+
+    length = grid_out.length
+    byte_range = parse_range(range_header, length) if length else None
+    status_code = 200
+    start, end = 0, length - 1
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Disposition"] = f"inline; filename={grid_out.filename}"
+    return StreamingResponse(
+        gridfs_stream(grid_out, start, end),
+        status_code=status_code,
+        media_type=grid_out.content_type,
+        headers=headers
+    )
+
+# Variantes redimensionadas (?w=&h=&format=)
+# Se generan una sola vez en un process pool y se guardan en GridFS con
+# metadata.variant_of apuntando al original
+IMAGE_VARIANT_MAX_SIZE = int(os.getenv("IMAGE_VARIANT_MAX_SIZE", "2048"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+image_pool = None
+
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return image_pool
+
+@app.on_event("shutdown")
+def close_image_pool():
+    if image_pool is not None:
+        image_pool.shutdown(wait=False, cancel_futures=True)
+
+def render_variant(data, w, h, fmt):
+    # Corre dentro del process pool
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.thumbnail((w or img.width, h or img.height))
+    if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format=fmt.upper())
+    return out.getvalue()
+
+async def image_variant(original, w, h, fmt):
+    if not fmt:
+        fmt = next((f for f, t in IMAGE_FORMATS.items() if t == original.content_type), "jpeg")
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(400, f"Unsupported format, use one of {sorted(IMAGE_FORMATS)}")
+
+    meta = {
+        "restaurant_id": original.metadata["restaurant_id"],
+        "variant_of": original._id,
+        "w": w, "h": h, "format": fmt
+    }
+    # Los requests concurrentes por la misma variante comparten una sola
+    # generación; entre procesos decide el índice único de DataLoader
+    try:
+        variant_id = await single_flight.do_async(
+            "image_variant", (str(original._id), w, h, fmt), lambda: store_variant(original, meta)
+        )
+    finally:
+        original.close()
+    return await run_in_threadpool(fs.get, variant_id)
+
+def find_variant(meta):
+    return db.fs.files.find_one(
+        {f"metadata.{k}": v for k, v in meta.items() if k != "restaurant_id"},
+        {"_id": 1}
+    )
+
+async def store_variant(original, meta):
+    existing = await run_in_threadpool(find_variant, meta)
+    if existing:
+        return existing["_id"]
+
+    w, h, fmt = meta["w"], meta["h"], meta["format"]
+    data = await run_in_threadpool(original.read)
+    loop = asyncio.get_running_loop()
+    try:
+        rendered = await loop.run_in_executor(get_image_pool(), render_variant, data, w, h, fmt)
+    except OSError:
+        # Pillow no pudo leer o escribir la imagen (UnidentifiedImageError es
+        # un OSError); sin Pillow o con el pool roto es un error del servidor
+        raise HTTPException(422, "Image cannot be resized")
+    variant_id = ObjectId()
+    try:
+        await run_in_threadpool(
+            fs.put, rendered,
+            _id=variant_id,
+            filename=f"{original.filename}-{w or ''}x{h or ''}.{fmt}",
+            contentType=IMAGE_FORMATS[fmt],
+            metadata=meta
+        )
+    except FileExists:
+        # Otro proceso la guardó primero (GridFS convierte el DuplicateKeyError
+        # del índice único): se descartan los chunks propios
+        await run_in_threadpool(db.fs.chunks.delete_many, {"files_id": variant_id})
+        return (await run_in_threadpool(find_variant, meta))["_id"]
+    return variant_id
 
 @app.get("/restaurants/{rid}/image/{file_id}")
-def get_image(rid: str, file_id: str):
+async def get_image(
+    rid: str, file_id: str,
+    w: Optional[int] = Query(None, ge=1, le=IMAGE_VARIANT_MAX_SIZE),
+    h: Optional[int] = Query(None, ge=1, le=IMAGE_VARIANT_MAX_SIZE),
+    format: Optional[str] = Query(None),
+    range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
     try:
-        grid_out = fs.get(ObjectId(file_id))
+        grid_out = await run_in_threadpool(fs.get, ObjectId(file_id))
     except NoFile:
         raise HTTPException(status_code=404, detail="Image not found")
 
@@ -511,11 +3037,6 @@ def get_image(rid: str, file_id: str):
     if meta.get("restaurant_id") != ObjectId(rid):
         raise HTTPException(status_code=404, detail="Image not found for this restaurant")
 
-    data = grid_out.read()
-    return Response(
-        content=data,
-        media_type=grid_out.contentType,
-        headers={"Content-Length": str(len(data)),
-                 "Content-Disposition": f"inline; filename={grid_out.filename}"}
-    )
-    
+    if w or h or format:
+        grid_out = await image_variant(grid_out, w, h, format)
+    return stream_grid_out(grid_out, range, if_none_match)
@@ -1,8 +1,14 @@
 # data_loader.py
 
 import os
+import time
 import random
-from datetime import datetime
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from bson import ObjectId, encode
+from bson.raw_bson import RawBSONDocument
 from faker import Faker
 from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT, GEOSPHERE
 
@@ -17,7 +23,7 @@ fake = Faker()
 # Drop y creación de colecciones con validadores JSON Schema
 def setup_collections():
     # Limpia si existen
-    for name in ["restaurants","users","menu_items","orders","reviews"]:
+    for name in ["restaurants","users","menu_items","orders","reviews","restaurant_ratings","menu_item_order_counts","user_stats","restaurant_rollups","restaurant_menus"]:
         try: db.drop_collection(name)
         except: pass
 
@@ -91,6 +97,7 @@ def setup_collections():
                     }
                 },
                 "status":{"enum":["pending","completed","cancelled"]},
+                "total":{"bsonType":"double"},
                 "created_at":{"bsonType":"date"}
             }
         }
@@ -114,9 +121,9 @@ def setup_collections():
 
 # Creación de índices
 def create_indexes():
-    # Restaurants texto sobre name/description, geo, simple sobre _id, compuesto sobre categories+name
+    # Restaurants texto sobre name/description, geo (+categories para /restaurants/nearby), simple sobre _id, compuesto sobre categories+name
     db.restaurants.create_index([("name","text"),("description","text")])
-    db.restaurants.create_index([("location","2dsphere")])
+    db.restaurants.create_index([("location","2dsphere"),("categories", ASCENDING)])
     db.restaurants.create_index([("categories", ASCENDING)])
     db.restaurants.create_index([("name", ASCENDING),("categories", ASCENDING)])
 
@@ -137,6 +144,189 @@ def create_indexes():
     db.reviews.create_index("rating")
     db.reviews.create_index([("restaurant_id", ASCENDING),("rating", DESCENDING)])
 
+    # Paginación por cursor: orden por defecto de cada listado + _id
+    db.restaurants.create_index([("name", ASCENDING),("_id", ASCENDING)])
+    db.users.create_index([("created_at", DESCENDING),("_id", DESCENDING)])
+    db.menu_items.create_index([("name", ASCENDING),("_id", ASCENDING)])
+    db.orders.create_index([("created_at", DESCENDING),("_id", DESCENDING)])
+    db.reviews.create_index([("created_at", DESCENDING),("_id", DESCENDING)])
+
+    # Listados filtrados: igualdad primero y luego el orden por defecto (ESR)
+    db.orders.create_index([("user_id", ASCENDING),("created_at", DESCENDING),("_id", DESCENDING)])
+    db.orders.create_index([("restaurant_id", ASCENDING),("created_at", DESCENDING),("_id", DESCENDING)])
+    db.reviews.create_index([("restaurant_id", ASCENDING),("created_at", DESCENDING),("_id", DESCENDING)])
+    db.reviews.create_index([("user_id", ASCENDING),("created_at", DESCENDING),("_id", DESCENDING)])
+    db.menu_items.create_index([("restaurant_id", ASCENDING),("name", ASCENDING),("_id", ASCENDING)])
+
+    # Resúmenes materializados para /restaurants/top-rated
+    db.restaurant_ratings.create_index([("avgRating", DESCENDING)])
+    db.menu_item_order_counts.create_index([("totalQty", DESCENDING)])
+
+    # Rollups por hora/día para /analytics
+    db.restaurant_rollups.create_index([("restaurant_id", ASCENDING),("granularity", ASCENDING),("bucket", ASCENDING)], unique=True)
+    db.restaurant_rollups.create_index([("granularity", ASCENDING),("bucket", ASCENDING)])
+
+    # Variantes redimensionadas de imágenes en GridFS (una por tamaño/formato;
+    # los originales no tienen variant_of y quedan fuera del índice)
+    db.fs.files.create_index([
+        ("metadata.variant_of", ASCENDING),("metadata.w", ASCENDING),
+        ("metadata.h", ASCENDING),("metadata.format", ASCENDING)
+    ], unique=True, partialFilterExpression={"metadata.variant_of": {"$exists": True}})
+
+# Carga masiva en paralelo (bulk-load)
+# Cada proceso genera su rango de documentos y los inserta con su propio
+# cliente en lotes acotados con insert_many(ordered=False). Los _id y precios
+# se derivan del índice del documento, así ningún proceso necesita leer lo
+# que insertaron los otros (ni volver a leer menu_items para los precios).
+BASE_COUNTS = {
+    "restaurants": 15000,
+    "users": 10000,
+    "menu_items": 50000,
+    "orders": 10000,
+    "reviews": 10000,
+}
+COLLECTION_TAGS = {"restaurants": 1, "users": 2, "menu_items": 3, "orders": 4, "reviews": 5}
+CATEGORIES = ["italian","chinese","japanese","mexican","vegan","fastfood"]
+TAGS = ["spicy","gluten-free","vegan","dessert","kids"]
+STATUSES = ["pending","completed","cancelled"]
+
+worker_db = None
+
+def init_worker(uri, db_name):
+    global worker_db
+    worker_db = MongoClient(uri)[db_name]
+
+def seq_oid(epoch, name, n):
+    # 4 bytes de timestamp, 1 de colección, 3 de relleno y 4 de secuencia
+    return ObjectId(struct.pack(">IB3xI", epoch, COLLECTION_TAGS[name], n))
+
+def item_restaurant(n, counts):
+    return n % min(counts["restaurants"], counts["menu_items"])
+
+def item_price(seed, n):
+    return round(random.Random(seed * 1000003 + n).uniform(5, 50), 2)
+
+def random_item(rng, restaurant, counts):
+    # Los platos del restaurante r son r, r + R, r + 2R, ... (R = restaurantes con platos)
+    stride = min(counts["restaurants"], counts["menu_items"])
+    per_restaurant = (counts["menu_items"] - restaurant - 1) // stride + 1
+    return restaurant + stride * rng.randrange(per_restaurant)
+
+def make_doc(name, n, rng, fake, ctx):
+    epoch, seed, counts, now = ctx["epoch"], ctx["seed"], ctx["counts"], ctx["now"]
+    if name == "restaurants":
+        return {
+            "_id": seq_oid(epoch, name, n),
+            "name": fake.company(),
+            "description": fake.text(max_nb_chars=200),
+            "location": {"type": "Point", "coordinates": [
+                round(rng.uniform(-180, 180), 6), round(rng.uniform(-90, 90), 6)
+            ]},
+            "categories": rng.sample(CATEGORIES, k=2)
+        }
+    if name == "users":
+        return {
+            "_id": seq_oid(epoch, name, n),
+            "username": fake.user_name(),
+            "email": f"user{n}@example.com",
+            "created_at": now - timedelta(seconds=rng.randrange(2 * 365 * 86400))
+        }
+    if name == "menu_items":
+        return {
+            "_id": seq_oid(epoch, name, n),
+            "restaurant_id": seq_oid(epoch, "restaurants", item_restaurant(n, counts)),
+            "name": fake.word().title(),
+            "description": fake.text(max_nb_chars=100),
+            "price": item_price(seed, n),
+            "tags": rng.sample(TAGS, k=2)
+        }
+    if name == "orders":
+        restaurant = rng.randrange(min(counts["restaurants"], counts["menu_items"]))
+        item_ids = {random_item(rng, restaurant, counts) for _ in range(rng.randint(2, 5))}
+        items = [{
+            "item_id": seq_oid(epoch, "menu_items", it),
+            "quantity": rng.randint(1, 3),
+            "unit_price": item_price(seed, it)
+        } for it in sorted(item_ids)]
+        return {
+            "_id": seq_oid(epoch, name, n),
+            "user_id": seq_oid(epoch, "users", rng.randrange(counts["users"])),
+            "restaurant_id": seq_oid(epoch, "restaurants", restaurant),
+            "items": items,
+            "total": round(sum(it["quantity"] * it["unit_price"] for it in items), 2),
+            "status": rng.choice(STATUSES),
+            "created_at": now - timedelta(seconds=rng.randrange(182 * 86400))
+        }
+    return {
+        "_id": seq_oid(epoch, name, n),
+        "user_id": seq_oid(epoch, "users", rng.randrange(counts["users"])),
+        "restaurant_id": seq_oid(epoch, "restaurants", rng.randrange(counts["restaurants"])),
+        "order_id": seq_oid(epoch, "orders", rng.randrange(counts["orders"])),
+        "rating": rng.randint(1, 5),
+        "comment": fake.sentence(nb_words=12),
+        "created_at": now - timedelta(seconds=rng.randrange(91 * 86400))
+    }
+
+def generate_batches(name, start, count, batch_size, ctx):
+    rng = random.Random(ctx["seed"] * 7919 + COLLECTION_TAGS[name] * 1000003 + start)
+    local_fake = Faker()
+    local_fake.seed_instance(ctx["seed"] + start)
+    batch = []
+    for n in range(start, start + count):
+        batch.append(RawBSONDocument(encode(make_doc(name, n, rng, local_fake, ctx))))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_range(name, start, count, batch_size, ctx):
+    docs = size = 0
+    for batch in generate_batches(name, start, count, batch_size, ctx):
+        worker_db[name].insert_many(batch, ordered=False)
+        docs += len(batch)
+        size += sum(len(doc.raw) for doc in batch)
+    return docs, size
+
+def bulk_load(scale=1.0, workers=None, batch_size=5000, seed=42):
+    counts = {name: max(1, int(base * scale)) for name, base in BASE_COUNTS.items()}
+    ctx = {"epoch": int(time.time()), "seed": seed, "counts": counts, "now": datetime.utcnow()}
+    workers = workers or os.cpu_count()
+    # Cada tarea cubre varios lotes para repartir el trabajo entre procesos
+    task_size = batch_size * 4
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(MONGO_URI, DB_NAME)) as pool:
+        for name in ["restaurants", "users", "menu_items", "orders", "reviews"]:
+            start_time = time.perf_counter()
+            futures = [
+                pool.submit(load_range, name, start, min(task_size, counts[name] - start), batch_size, ctx)
+                for start in range(0, counts[name], task_size)
+            ]
+            docs = size = 0
+            for future in as_completed(futures):
+                d, s = future.result()
+                docs += d
+                size += s
+            elapsed = time.perf_counter() - start_time
+            print(f"{name:<12} {docs:>10} docs  {elapsed:8.2f} s  "
+                  f"{docs / elapsed:10.0f} docs/s  {size / elapsed / 1e6:8.2f} MB/s")
+
+# Reconstrucción de las colecciones derivadas (mismas funciones que usa la API)
+PROJECTIONS = ["ratings", "counters", "users", "rollups", "menus"]
+
+def rebuild_projections(names=None):
+    import ApiServer
+    rebuilders = {
+        "ratings": ApiServer.rebuild_rating_summaries,
+        "counters": ApiServer.rebuild_item_order_counts,
+        "users": ApiServer.rebuild_user_stats,
+        "rollups": ApiServer.rebuild_rollups,
+        "menus": ApiServer.rebuild_restaurant_menus,
+    }
+    for name in names or PROJECTIONS:
+        print(f"{name}: {rebuilders[name](db)} documentos")
+
 # Generación de datos
 def generate_data():
     # Restaurantes
@@ -181,18 +371,21 @@ def generate_data():
     mid = db.menu_items.insert_many(menu_items).inserted_ids
 
     # Cachear todos los precios en memoria para acelerar las ordenes
-    price_map = {
-        doc["_id"]: doc["price"]
-        for doc in db.menu_items.find({}, {"price": 1})
-    }
+    price_map = {_id: doc["price"] for _id, doc in zip(mid, menu_items)}
+    # Platos por restaurante: la API rechaza items de otro restaurante
+    menus = {}
+    for _id, doc in zip(mid, menu_items):
+        menus.setdefault(doc["restaurant_id"], []).append(_id)
+    with_menu = list(menus)
 
     # Ordenes 
     orders = []
     for _ in range(10000):
         user_id = random.choice(uids)
-        rest_id = random.choice(restaurant_ids)
+        rest_id = random.choice(with_menu)
+        menu = menus[rest_id]
         items = []
-        for it in random.sample(mid, k=random.randint(2,5)):
+        for it in random.sample(menu, k=min(random.randint(2,5), len(menu))):
             items.append({
                 "item_id": it,
                 "quantity": random.randint(1,3),
@@ -202,6 +395,7 @@ def generate_data():
             "user_id": user_id,
             "restaurant_id": rest_id,
             "items": items,
+            "total": round(sum(it["quantity"] * it["unit_price"] for it in items), 2),
             "status": random.choice(["pending","completed","cancelled"]),
             "created_at": fake.date_time_between(start_date="-6m", end_date="now")
         })
@@ -226,6 +420,32 @@ def generate_data():
     print(f"¡Datos cargados! Total de documentos: {total}")
 
 if __name__ == "__main__":
-    setup_collections()
-    create_indexes()
-    generate_data()
+    parser = argparse.ArgumentParser(description="Carga y mantenimiento de datos")
+    parser.add_argument("command", nargs="?", default="load",
+                        choices=["load", "bulk-load", "rebuild"])
+    parser.add_argument("projections", nargs="*", choices=PROJECTIONS,
+                        help="Proyecciones a reconstruir (por defecto todas)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="bulk-load: multiplica la cantidad de documentos base")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="bulk-load: procesos generadores/escritores (por defecto, núcleos)")
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="bulk-load: documentos por insert_many")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.command == "load":
+        setup_collections()
+        create_indexes()
+        generate_data()
+        rebuild_projections()
+    elif args.command == "bulk-load":
+        # Índices después de la carga: insertar sin índices es mucho más rápido
+        setup_collections()
+        bulk_load(args.scale, args.workers, args.batch_size, args.seed)
+        start = time.perf_counter()
+        create_indexes()
+        print(f"índices creados en {time.perf_counter() - start:.2f} s")
+        rebuild_projections()
+    elif args.command == "rebuild":
+        rebuild_projections(args.projections)